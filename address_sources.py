@@ -0,0 +1,244 @@
+"""
+File Name: address_sources.py
+
+# Introduction
+
+This file contains the sources that `aws_dns` can use to learn the public IP
+address of the host. Each source is a class with a `name` attribute and a `get`
+method that returns the address as a string, or raises an exception if the
+source cannot provide it. `get` takes a timeout in floating-point seconds, and
+raises `TimeoutError` if the source does not answer in time. The following
+sources are available:
+
+  - `nat_pmp_source` asks the default gateway for its external address using
+    NAT-PMP (RFC 6886). This is a single UDP round trip on the LAN, and works
+    with most home and office routers.
+  - `imds_source` asks the EC2 instance metadata service for the public IPv4
+    address of the instance, using IMDSv2 session tokens.
+  - `http_source` asks an HTTP echo service on the public internet.
+
+A `source_chain` tries the sources in order, so that the local sources can be
+used when they are available, with the HTTP echo service as a fallback.
+
+# Testing
+
+The gateway address, port, and metadata endpoint can be passed explicitly, so
+that local UDP and HTTP servers can stand in for the router and EC2.
+"""
+
+import time
+import struct
+import socket
+import logging
+import ipaddress
+import urllib3
+
+"""
+Parses a textual address returned by a source. If `public` is true, addresses
+that are not globally routable are rejected, since a gateway behind another NAT
+(e.g. carrier-grade NAT) only knows its own private address.
+"""
+def parse_address(text, public=False):
+	addr = ipaddress.IPv4Address(text.strip())
+	if public and not addr.is_global:
+		raise Exception("Address {0} is not public.".format(addr))
+	return str(addr)
+
+"""
+Returns the address of the default IPv4 gateway, as listed in
+`/proc/net/route`.
+"""
+def default_gateway():
+	with open("/proc/net/route") as f:
+		for line in f.readlines()[1:]:
+			fields = line.split()
+			# The gateway flag is 0x2.
+			if fields[1] == "00000000" and int(fields[3], 16) & 0x2:
+				return socket.inet_ntoa(struct.pack("<I", int(fields[2], 16)))
+	raise Exception("No default gateway in /proc/net/route.")
+
+class http_source:
+	name = "http"
+
+	def __init__(self, url="http://ip.42.pl/raw"):
+		self.url  = url
+		self.http = urllib3.PoolManager()
+
+	def get(self, timeout=None):
+		try:
+			r = self.http.request("GET", self.url, retries=False,
+				timeout=urllib3.Timeout(total=timeout))
+		except urllib3.exceptions.TimeoutError as e:
+			raise TimeoutError(str(e))
+		if r.status != 200:
+			raise Exception("Bad response code: {0}".format(r.status))
+		return parse_address(r.data.decode("utf-8"))
+
+"""
+Summary of parameters:
+
+  - `gateway` is the address of the NAT-PMP server. By default, the default
+    gateway is used.
+  - `port` is the NAT-PMP server port.
+  - `timeout` is the initial floating-point number of seconds to wait for a
+    response. As recommended by RFC 6886, it is doubled after each of the
+    `tries` attempts.
+"""
+class nat_pmp_source:
+	name = "nat-pmp"
+
+	# Version 0, opcode 0: external address request.
+	request = b"\x00\x00"
+
+	def __init__(self, gateway=None, port=5351, timeout=0.25, tries=3):
+		self.gateway = gateway
+		self.port    = port
+		self.timeout = timeout
+		self.tries   = tries
+
+	def get(self, timeout=None):
+		gateway = self.gateway or default_gateway()
+		end = time.monotonic() + (timeout if timeout is not None else 3600)
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			sock.connect((gateway, self.port))
+			wait = self.timeout
+			for _ in range(self.tries):
+				left = end - time.monotonic()
+				if left <= 0:
+					break
+				sock.send(self.request)
+				sock.settimeout(min(wait, left))
+				try:
+					return self.parse(sock.recv(16))
+				except socket.timeout:
+					wait *= 2
+		finally:
+			sock.close()
+		if time.monotonic() >= end:
+			raise TimeoutError("No NAT-PMP response from {0} in time.".
+				format(gateway))
+		raise Exception("No NAT-PMP response from {0}.".format(gateway))
+
+	@staticmethod
+	def parse(data):
+		if len(data) >= 2 and data[0] != 0:
+			# PCP servers answer NAT-PMP requests from gateways that
+			# do not also implement NAT-PMP with this version.
+			raise Exception("Gateway only supports PCP (version {0}).".
+				format(data[0]))
+		if len(data) < 12:
+			raise Exception("Short NAT-PMP response: {0}".format(data))
+
+		(version, opcode, result, _, addr) = struct.unpack("!BBHI4s", data[:12])
+		if opcode != 128:
+			raise Exception("Unexpected NAT-PMP opcode: {0}".format(opcode))
+		if result != 0:
+			raise Exception("NAT-PMP result code: {0}".format(result))
+		return parse_address(socket.inet_ntoa(addr), public=True)
+
+"""
+Summary of parameters:
+
+  - `endpoint` is the base URL of the metadata service.
+  - `token_ttl` is the lifetime of the session tokens that are requested, in
+    seconds. Tokens are cached and reused until shortly before they expire.
+  - `timeout` is the maximum floating-point number of seconds to wait for
+    each request. The metadata service is local, so this should be short.
+"""
+class imds_source:
+	name = "imds"
+
+	def __init__(self, endpoint="http://169.254.169.254", token_ttl=21600,
+		timeout=1):
+		self.endpoint  = endpoint
+		self.token_ttl = token_ttl
+		self.timeout   = timeout
+		self.http      = urllib3.PoolManager(retries=False)
+		self.token     = None
+		self.expiry    = 0
+
+	def request(self, method, path, headers, end):
+		timeout = min(self.timeout, end - time.monotonic())
+		if timeout <= 0:
+			raise TimeoutError("Out of time for metadata request.")
+		try:
+			return self.http.request(method, self.endpoint + path,
+				headers=headers, timeout=urllib3.Timeout(total=timeout))
+		except urllib3.exceptions.TimeoutError as e:
+			raise TimeoutError(str(e))
+
+	def get_token(self, end):
+		if self.token is not None and time.monotonic() < self.expiry:
+			return self.token
+
+		r = self.request("PUT", "/latest/api/token",
+			{"X-aws-ec2-metadata-token-ttl-seconds": str(self.token_ttl)}, end)
+		if r.status != 200:
+			raise Exception("Bad response code for token: {0}".format(r.status))
+		self.token = r.data.decode("utf-8")
+		# Renew the token a minute early, so that it does not expire
+		# between being checked and being used.
+		self.expiry = time.monotonic() + self.token_ttl - 60
+		return self.token
+
+	def get(self, timeout=None):
+		end = time.monotonic() + (timeout if timeout is not None else 3600)
+		for _ in range(2):
+			r = self.request("GET", "/latest/meta-data/public-ipv4",
+				{"X-aws-ec2-metadata-token": self.get_token(end)}, end)
+			# The token may have been invalidated early, e.g. if the
+			# instance was stopped and started again.
+			if r.status == 401:
+				self.token = None
+				continue
+			if r.status == 404:
+				raise Exception("Instance has no public IPv4 address.")
+			if r.status != 200:
+				raise Exception("Bad response code: {0}".format(r.status))
+			return parse_address(r.data.decode("utf-8"), public=True)
+		raise Exception("Metadata service rejected the session token.")
+
+"""
+Tries each source in `sources` in order, and returns the first address that is
+obtained. A source that fails is skipped for `backoff` floating-point seconds,
+so that hosts without a NAT-PMP gateway or outside of EC2 do not pay for a
+timeout on every check. The timeout passed to `get` is shared by all of the
+sources that are tried.
+"""
+class source_chain:
+	def __init__(self, sources, backoff=3600):
+		self.sources = sources
+		self.backoff = backoff
+		self.skip    = {}
+
+	def get(self, timeout=None):
+		logger = logging.getLogger("aws_dns")
+		end = time.monotonic() + (timeout if timeout is not None else 3600)
+		(errors, timed_out) = ([], False)
+		for (i, source) in enumerate(self.sources):
+			last = i == len(self.sources) - 1
+			if not last and time.monotonic() < self.skip.get(source.name, 0):
+				continue
+			left = end - time.monotonic()
+			if left <= 0:
+				raise TimeoutError("Out of time after trying: {0}".
+					format("; ".join(errors)))
+			try:
+				ip = source.get(left)
+				self.skip.pop(source.name, None)
+				return ip
+			except Exception as e:
+				errors.append("{0}: {1}".format(source.name, e))
+				timed_out = isinstance(e, TimeoutError)
+				if not last:
+					logger.info("Address source {0} failed: {1}".
+						format(source.name, e))
+					logger.info("Skipping it for {0:.0f} seconds.".
+						format(self.backoff))
+					self.skip[source.name] = time.monotonic() + self.backoff
+		if timed_out:
+			raise TimeoutError("All address sources failed: {0}".
+				format("; ".join(errors)))
+		raise Exception("All address sources failed: {0}".
+			format("; ".join(errors)))
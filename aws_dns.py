@@ -14,10 +14,16 @@ import sys
 import time
 import logging
 import logging.handlers
+import signal
 import traceback
+import re
 import json
-import urllib3
-from subprocess import Popen, PIPE
+import tempfile
+import statistics
+from itertools import groupby
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from subprocess import Popen, PIPE, TimeoutExpired
 
 sys.path.append("/usr/lib/python_service")
 aws_path     = "/usr/local/bin"
@@ -25,77 +31,139 @@ service_path = "/etc/init.d/aws_dns"
 pidfile      = "/var/run/aws_dns.pid"
 logfile      = "/var/log/aws_dns.log"
 conf_file    = "/etc/aws_dns.conf"
+default_ttl  = 300
+
+# Set by `run` when the credentials are resolved by the daemon rather than by
+# each `aws` process. Otherwise, the `aws` processes are given the configured
+# profile, if any.
+aws_credentials = None
+aws_profile     = None
 
 os.environ["PATH"] += os.path.pathsep + aws_path
-from system_v import service
+from system_v import service, exit_success, exit_failure
+from systemd import notifier
+from address_sources import source_chain, http_source, nat_pmp_source, \
+	imds_source
+from credentials import credential_provider, unsupported
+from timers import timer_wheel
+from dns_update import rfc2136_backend, tsig_key
 
-def get_json(cmd):
+"""
+Runs `cmd` and parses its output as JSON. If the command does not finish within
+`timeout` floating-point seconds, it is killed and `TimeoutError` is raised.
+"""
+def get_json(cmd, timeout=None):
 	logger = logging.getLogger("aws_dns")
-	out, err = Popen(cmd, stdout=PIPE, stderr=PIPE).communicate()
+	env = None
+	if aws_credentials is not None:
+		env = aws_credentials.env()
+	elif aws_profile is not None:
+		env = dict(os.environ, AWS_PROFILE=aws_profile)
+	proc = Popen(cmd, stdout=PIPE, stderr=PIPE, env=env)
+	try:
+		out, err = proc.communicate(timeout=timeout)
+	except TimeoutExpired:
+		proc.kill()
+		proc.communicate()
+		raise TimeoutError("Command {0} killed after {1:.1f} seconds.".
+			format(cmd[:3], timeout))
+	if proc.returncode != 0:
+		raise Exception("Command {0} failed: {1}".
+			format(cmd[:3], err.decode("utf-8").strip()))
 	if len(err) != 0:
 		logger.warning("Command {0} reported error: {1}".
 			format(cmd, err.decode("utf-8")))
 	return json.loads(out.decode("utf-8"))
 
-def get_set_ip(domain, zone_id):
+"""
+Returns a dictionary mapping each domain in `domains` to the `(address, TTL)`
+pair of its A record. If `allow_missing` is true, domains without an A record
+are mapped to `(None, None)` instead of raising an exception.
+"""
+def get_records(domains, zone_id, allow_missing=False, timeout=None):
 	logger = logging.getLogger("aws_dns")
 	res = get_json(['aws', 'route53', 'list-resource-record-sets',
-		'--hosted-zone-id', zone_id, '--output', 'json'])
+		'--hosted-zone-id', zone_id, '--output', 'json'], timeout)
 	sets = res["ResourceRecordSets"]
-	try:
-		l = list(filter(lambda r: r["Type"] == "A" and r["Name"] == domain, sets))
-	except KeyError as e:
-		raise Exception("No key {0} in record sets: {1}".format(e.args[0], sets))
-
-	if len(l) == 0:
-		raise Exception("No matching A record in response: {0}".format(sets))
-	elif len(l) > 1:
-		logger.warning("Multiple A records match domain: using first match.")
-
-	addresses = list(filter(lambda r: "Value" in r, l[0]["ResourceRecords"]))
-	if len(addresses) == 0:
-		logger.warning("Matching A record has no address value.")
-	elif len(addresses) > 1:
-		logger.warning("Matching A record has multiple address values.")
-		logger.warning("Only the first one will be considered.")
-	return addresses[0]["Value"]
-
-def get_public_ip():
-	http = urllib3.PoolManager()
-	r = http.request("GET", "http://ip.42.pl/raw")
-	if r.status != 200:
-		raise Exception("Bad response code: {0}".format(r.status))
-	return r.data.decode("utf-8")
-
-def update_record(domain, zone_id, old_ip, new_ip):
-	change_query = json.dumps({
-		"Changes": [
-			{
-				"Action": "DELETE",
-				"ResourceRecordSet": {
-					"Name": domain,
-					"Type": "A",
-					"ResourceRecords": [{"Value": old_ip}],
-					"TTL": 300
-				}
-			},
-			{
-				"Action": "CREATE",
+
+	records = {}
+	for domain in domains:
+		try:
+			l = list(filter(lambda r: r["Type"] == "A" and r["Name"] == domain, sets))
+		except KeyError as e:
+			raise Exception("No key {0} in record sets: {1}".format(e.args[0], sets))
+
+		if len(l) == 0 and allow_missing:
+			records[domain] = (None, None)
+			continue
+		elif len(l) == 0:
+			raise Exception("No matching A record for {0} in response: {1}".
+				format(domain, sets))
+		elif len(l) > 1:
+			logger.warning("Multiple A records match {0}: using first match.".
+				format(domain))
+
+		addresses = list(filter(lambda r: "Value" in r, l[0]["ResourceRecords"]))
+		if len(addresses) == 0:
+			raise Exception("A record for {0} has no address value.".
+				format(domain))
+		elif len(addresses) > 1:
+			logger.warning("A record for {0} has multiple address values.".
+				format(domain))
+			logger.warning("Only the first one will be considered.")
+		if not "TTL" in l[0]:
+			raise Exception("A record for {0} has no TTL.".format(domain))
+		records[domain] = (addresses[0]["Value"], l[0]["TTL"])
+	return records
+
+"""
+Submits all of the updates in `updates`, a list of `(domain, old, new)` tuples
+where `old` and `new` are `(address, TTL)` pairs, as a single change batch. The
+old pair must match the live record exactly for the deletion to succeed.
+
+If `upsert` is true, each record is written with a single `UPSERT` of the new
+pair instead. This does not depend on the old value, so the write succeeds even
+if the record was edited or removed by someone else, and repeating it is
+harmless.
+
+Route 53 applies a batch atomically, so coalescing the updates for several
+records costs one request and one pending change instead of one per record.
+"""
+def update_records(zone_id, updates, upsert=False, timeout=None):
+	changes = []
+	for (domain, old, new) in updates:
+		if upsert:
+			actions = [("UPSERT", new)]
+		else:
+			actions = [("DELETE", old), ("CREATE", new)]
+		for (action, (ip, ttl)) in actions:
+			changes.append({
+				"Action": action,
 				"ResourceRecordSet": {
 					"Name": domain,
 					"Type": "A",
-					"ResourceRecords": [{"Value": new_ip}],
-					"TTL": 300
+					"ResourceRecords": [{"Value": ip}],
+					"TTL": ttl
 				}
-			}
-		]
-	})
-	info = get_json(
-		['aws', 'route53', 'change-resource-record-sets',
-		'--hosted-zone-id', zone_id, '--change-batch', change_query,
-		'--output', 'json']
-	)
-	
+			})
+	return submit_changes(zone_id, changes, timeout)
+
+"""
+Submits the list of changes `changes` as a single change batch, and returns a
+pair indicating whether the change is already in sync and its ID. The batch is
+passed to the `aws` command through a temporary file, since large batches
+exceed the maximum length of a command-line argument.
+"""
+def submit_changes(zone_id, changes, timeout=None):
+	with tempfile.NamedTemporaryFile("w", prefix="aws_dns-", suffix=".json") as f:
+		json.dump({"Changes": changes}, f)
+		f.flush()
+		info = get_json(
+			['aws', 'route53', 'change-resource-record-sets',
+			'--hosted-zone-id', zone_id, '--change-batch', 'file://' + f.name,
+			'--output', 'json'], timeout
+		)
+
 	if not "ChangeInfo" in info:
 		raise Exception("No key {0} in response: {1}".format("ChangeInfo", info))
 	for key in ["Status", "Id"]:
@@ -104,9 +172,9 @@ def update_record(domain, zone_id, old_ip, new_ip):
 				format(key, info["ChangeInfo"]))
 	return (info["ChangeInfo"]["Status"] == "INSYNC", info["ChangeInfo"]["Id"])
 
-def change_committed(change_id):
+def change_committed(change_id, timeout=None):
 	info = get_json(['aws', 'route53', 'get-change', '--id', change_id,
-		'--output', 'json'])
+		'--output', 'json'], timeout)
 
 	if not "ChangeInfo" in info:
 		raise Exception("No key {0} in response: {1}".format("ChangeInfo", info))
@@ -114,97 +182,732 @@ def change_committed(change_id):
 		if not key in info["ChangeInfo"]:
 			raise Exception("No key {0} in change info: {1}".
 				format(key, info["ChangeInfo"]))
-	return info["ChangeInfo"]["Status"] == "PENDING" 
+	return info["ChangeInfo"]["Status"] == "INSYNC"
+
+"""
+The DNS backend used by `start`. A backend provides the following methods:
+
+  - `read_records(domains, allow_missing, timeout)`, as `get_records`.
+  - `write_batch(updates, upsert, timeout)`, as `update_records`.
+  - `committed(change_id, timeout)`, as `change_committed`.
+
+Besides this one, `dns_update.rfc2136_backend` updates our own authoritative
+server using DNS UPDATE.
+"""
+class route53_backend:
+	def __init__(self, zone_id):
+		self.zone_id = zone_id
+
+	def read_records(self, domains, allow_missing=False, timeout=None):
+		return get_records(domains, self.zone_id, allow_missing, timeout)
+
+	def write_batch(self, updates, upsert=False, timeout=None):
+		return update_records(self.zone_id, updates, upsert, timeout)
+
+	def committed(self, change_id, timeout=None):
+		return change_committed(change_id, timeout)
+
+"""
+Route 53 escapes some characters in record names (e.g. `*` as `\\052`), so names
+are decoded and lowercased before being compared.
+"""
+def normalize_name(name):
+	name = re.sub(r"\\(\d{3})", lambda m: chr(int(m.group(1), 8)), name).lower()
+	return name if name.endswith(".") else name + "."
+
+"""
+Reads the declarative record file used by `sync`. The file is a JSON object
+with the following keys:
+
+  - `hosted-zone-id`: the hosted zone to synchronize.
+  - `records`: a list of objects with the keys `name`, `type`, `ttl`, and
+    `values` (a list of strings) that describe the desired record sets.
+  - `prune` (optional): if true, simple record sets in the zone that are not
+    listed are deleted. The SOA and apex NS records are never deleted.
+"""
+def read_desired(path):
+	spec = json.load(open(path))
+	if type(spec) != dict or not "hosted-zone-id" in spec or not "records" in spec:
+		raise Exception("File must have \"hosted-zone-id\" and \"records\" keys.")
+
+	records = {}
+	for (i, r) in enumerate(spec["records"]):
+		if type(r) != dict or any(not k in r for k in ["name", "type", "ttl", "values"]):
+			raise Exception("Record {0} must have \"name\", \"type\", "
+				"\"ttl\", and \"values\" keys.".format(i))
+		if type(r["ttl"]) != int or type(r["values"]) != list or \
+			len(r["values"]) == 0 or any(type(v) != str for v in r["values"]):
+			raise Exception("Record {0} must have an integer TTL and a "
+				"nonempty list of values.".format(i))
+		key = (normalize_name(r["name"]), r["type"].upper())
+		if key in records:
+			raise Exception("Record {0} duplicates {1} {2}.".format(i, *key))
+		records[key] = (r["ttl"], sorted(r["values"]))
+	return (spec["hosted-zone-id"], records, spec.get("prune", False) is True)
+
+"""
+Computes the minimal list of changes that turns the record sets `existing`, as
+returned by Route 53, into `desired`. Alias and routing-policy record sets are
+not managed. Returns the changes and the number of record sets that are already
+up to date.
+
+The changes are grouped by name, with the deletions for each name first, so that
+a record set that changes type (e.g. from A to CNAME) is deleted before the new
+one is created.
+"""
+def diff_records(desired, existing, prune):
+	current = {}
+	apex = None
+	for r in existing:
+		if r["Type"] == "SOA":
+			apex = normalize_name(r["Name"])
+		if not "AliasTarget" in r and not "SetIdentifier" in r:
+			current[(normalize_name(r["Name"]), r["Type"])] = r
+
+	(changes, unchanged) = ([], 0)
+	for (key, (ttl, values)) in desired.items():
+		old = current.get(key)
+		if old is not None and old.get("TTL") == ttl and \
+			sorted(v["Value"] for v in old["ResourceRecords"]) == values:
+			unchanged += 1
+			continue
+		changes.append({
+			"Action": "CREATE" if old is None else "UPSERT",
+			"ResourceRecordSet": {
+				"Name": key[0],
+				"Type": key[1],
+				"TTL": ttl,
+				"ResourceRecords": [{"Value": v} for v in values]
+			}
+		})
+
+	deletes = []
+	if prune:
+		for (key, r) in current.items():
+			if key in desired or key[1] == "SOA" or \
+				key[1] == "NS" and key[0] == apex:
+				continue
+			deletes.append({"Action": "DELETE", "ResourceRecordSet": r})
+
+	# The sort is stable, so the deletions stay ahead of the other changes.
+	changes = sorted(deletes + changes,
+		key=lambda c: normalize_name(c["ResourceRecordSet"]["Name"]))
+	return (changes, unchanged)
+
+"""
+Splits `changes` into batches that respect the Route 53 limits on the number of
+`ResourceRecord` elements and the total length of their values in one request.
+Both limits count `UPSERT` changes twice. Consecutive changes to the same name
+are kept in the same batch, so that a deletion is never separated from the
+creation that depends on it.
+"""
+def chunk_changes(changes, max_records=1000, max_chars=32000):
+	(chunks, records, chars) = ([[]], 0, 0)
+	for (_, group) in groupby(changes,
+		lambda c: normalize_name(c["ResourceRecordSet"]["Name"])):
+		(group, r, n) = (list(group), 0, 0)
+		for c in group:
+			factor = 2 if c["Action"] == "UPSERT" else 1
+			rrs = c["ResourceRecordSet"].get("ResourceRecords", [])
+			r += factor * len(rrs)
+			n += factor * sum(len(v["Value"]) for v in rrs)
+		if len(chunks[-1]) != 0 and (records + r > max_records or
+			chars + n > max_chars):
+			(records, chars) = (0, 0)
+			chunks.append([])
+		chunks[-1].extend(group)
+		(records, chars) = (records + r, chars + n)
+	return [c for c in chunks if len(c) != 0]
 
-def get_status(domain, zone_id):
+"""
+Polls the change `change_id` until it is in sync, backing off from two to
+fifteen seconds between polls. Raises `TimeoutError` after `timeout` seconds.
+"""
+def wait_committed(change_id, timeout):
+	(end, interval) = (time.monotonic() + timeout, 2)
+	while not change_committed(change_id, 60):
+		if time.monotonic() + interval > end:
+			raise TimeoutError("Change {0} not committed after {1} seconds.".
+				format(change_id, timeout))
+		time.sleep(interval)
+		interval = min(2 * interval, 15)
+
+"""
+Filters out short-lived changes of the public IP, so that a bouncing link or a
+provider that briefly reports a wrong address does not cause a burst of
+updates. A new address is only accepted once it has been observed
+`observations` times in a row, or has been observed consistently for `window`
+floating-point seconds, whichever comes first. Either criterion can be
+disabled by setting it to `None`; if both are disabled, new addresses are
+accepted immediately. If the address reverts to the accepted one before the new
+one is accepted, the pending change is cancelled.
+"""
+class debouncer:
+	def __init__(self, stable_ip=None, observations=None, window=None):
+		self.stable_ip    = stable_ip
+		self.observations = observations
+		self.window       = window
+		self.candidate    = None
+		self.count        = 0
+		self.since        = 0
+
+	"""
+	Records an observation of the public IP made at time `now`, and returns
+	the address that should be published.
+	"""
+	def observe(self, ip, now):
+		logger = logging.getLogger("aws_dns")
+		if self.stable_ip is None:
+			self.stable_ip = ip
+		if ip == self.stable_ip:
+			if self.candidate is not None:
+				logger.info("Public IP reverted to {0}; cancelling change to {1}.".
+					format(ip, self.candidate))
+				self.candidate = None
+			return self.stable_ip
+
+		if ip != self.candidate:
+			self.candidate = ip
+			self.count = 0
+			self.since = now
+		self.count += 1
+
+		if self.observations is None and self.window is None or \
+			self.observations is not None and self.count >= self.observations or \
+			self.window is not None and now - self.since >= self.window:
+			self.stable_ip = ip
+			self.candidate = None
+		else:
+			logger.info("Public IP changed to {0}; waiting for it to stabilize "
+				"({1} observations over {2:.0f} seconds so far).".
+				format(ip, self.count, now - self.since))
+		return self.stable_ip
+
+	"""
+	Returns true if the candidate address is likely to be accepted, i.e. it
+	has been observed at least twice, or for half of the stability window.
+	A single observation may just be a bogus response, so it is not enough.
+	"""
+	def expecting(self, now):
+		if self.candidate is None:
+			return False
+		return self.count >= 2 or \
+			self.window is not None and now - self.since >= self.window / 2
+
+"""
+Chooses the TTL of a record based on how often its address changes. The TTL
+grows with the time for which the address has been stable, so that resolvers
+query less often while nothing is changing, but is capped by a fraction of the
+typical interval between recent changes, so that a volatile address keeps a
+short TTL. When a change is expected (i.e. a new address is being debounced and
+is likely to be accepted), or has just been made, the minimum TTL is used so
+that caches expire quickly. Flaps that are cancelled count toward the
+volatility of the address, but not toward the time for which it has been
+stable.
+
+Since the history before the daemon started is unknown, the address is assumed
+to have been stable for long enough to justify the live TTL, so that restarting
+the daemon does not rewrite every record.
+"""
+class ttl_policy:
+	# The TTL is this fraction of the stable time or change interval.
+	fraction = 0.25
+
+	def __init__(self, min_ttl, max_ttl, live_ttl, now):
+		self.min_ttl     = min_ttl
+		self.max_ttl     = max_ttl
+		self.last_change = now - live_ttl / self.fraction
+		self.last_event  = self.last_change
+		self.intervals   = deque(maxlen=8)
+
+	"""
+	Records a change of the record's address. A debounced change was
+	already recorded as an event when it was first observed, so it is not
+	counted again; otherwise, the debounce delay would be counted as a
+	change interval of its own.
+	"""
+	def changed(self, now):
+		if self.last_event <= self.last_change:
+			self.flapped(now)
+		self.last_change = now
+
+	"""
+	Records a short-lived change of the address, which did not change the
+	record.
+	"""
+	def flapped(self, now):
+		self.intervals.append(now - self.last_event)
+		self.last_event = now
+
+	def target(self, now, unstable):
+		if unstable:
+			return self.min_ttl
+		ttl = self.fraction * (now - self.last_change)
+		if len(self.intervals) != 0:
+			ttl = min(ttl, self.fraction * statistics.median(self.intervals))
+		return int(max(self.min_ttl, min(self.max_ttl, ttl)))
+
+	"""
+	Returns true if the record should be rewritten to change its TTL from
+	`live` to `target`. Small adjustments are not worth a change batch, so
+	the TTL is only changed by factors of two, or to one of the bounds.
+	"""
+	def should_update(self, live, target):
+		if target > live:
+			return target >= 2 * live or target == self.max_ttl
+		elif target < live:
+			return 2 * target <= live or target == self.min_ttl
+		return False
+
+"""
+Bounds the time taken by one check, so that a stuck connection or a wedged
+`aws` process cannot freeze the daemon. The deadline for the whole check is
+split into a budget for each stage, which is passed to the stage as its
+timeout. Stages that run out of time raise `TimeoutError`.
+"""
+class deadline:
+	# Fraction of the deadline given to each stage.
+	shares = {"commit": 0.2, "reconcile": 0.3, "address": 0.2, "update": 0.3}
+
+	def __init__(self, total):
+		self.total = total
+		self.end   = time.monotonic() + total
+
+	def budget(self, stage):
+		left = self.end - time.monotonic()
+		if left <= 0:
+			raise TimeoutError("Deadline of {0} seconds exceeded before "
+				"{1} stage.".format(self.total, stage))
+		return min(left, self.shares[stage] * self.total)
+
+def format_stats(stats):
+	return "Cycle {0}: public IP {1}, records {2}, {3} updates, {4} errors, " \
+		"{5} timeouts, {6:.1f} wakeups/hour.".format(stats["cycles"],
+		stats["cur-ip"], stats["set-ip"], stats["updates"], stats["errors"],
+		stats["timeouts"], stats["wakeups"])
+
+"""
+Resolves the AWS credentials with `provider`, retrying every 10 seconds, since
+STS may not be reachable yet at boot. Returns the provider, or `None` if its
+credential sources are not supported and have to be left to the `aws` command.
+"""
+def resolve_credentials(provider, notify):
 	logger = logging.getLogger("aws_dns")
-	set_ip = get_set_ip(domain, zone_id)
-	cur_ip = get_public_ip()
-	logger.info("Current address associated with domain: " + set_ip)
-	logger.info("Current public IP address: " + cur_ip)
-
-	if set_ip != cur_ip:
-		change_id = update_record(domain, zone_id, set_ip, cur_ip)[1]
-		change_pending = True
-		logger.info("Successfully updated record.")
-	else:
-		change_id = ""
-		change_pending = False
-	return (set_ip, cur_ip, change_pending, change_id)
-
-def start(domain, zone_id, recheck):
+	while True:
+		try:
+			provider.start()
+			return provider
+		except unsupported as e:
+			logger.info("{0} Leaving credentials to the aws command.".
+				format(e))
+			return None
+		except Exception as e:
+			logger.warning("Failed to resolve AWS credentials: {0}".format(e))
+			logger.warning("Next attempt in 10 seconds.")
+			notify.status("Failed to resolve AWS credentials: {0}".format(e))
+			notify.sleep(10)
+
+def start(domains, backend, recheck, notify, sources, observations, window,
+	min_ttl, max_ttl, upsert, reconcile, cycle_deadline, slack):
 	logger = logging.getLogger("aws_dns")
 
+	# In UPSERT mode, missing records are simply created by the first
+	# update. Nothing else happens at startup, so the read is given the
+	# whole deadline of a check.
 	while True:
 		try:
-			status = get_status(domain, zone_id)
+			records = backend.read_records(domains, upsert, cycle_deadline)
 			break
 		except Exception as e:
 			logger.warning("Failed to get initial status: {0}".format(e))
 			logger.warning(traceback.format_exc())
 			logger.warning("Next attempt in 10 seconds.")
-			time.sleep(10)
+			notify.status("Failed to get initial status: {0}".format(e))
+			notify.sleep(10)
 
-	(set_ip, cur_ip, change_pending, change_id) = status
+	# All of the periodic work is scheduled on one timer wheel, so that
+	# work that falls due at nearby times is done in a single wakeup. The
+	# wheel's clock keeps running during suspension, so the stability and
+	# volatility of the address are measured in wall-clock terms.
+	wheel = timer_wheel()
+	now = wheel.now()
+	for domain in domains:
+		if records[domain][0] is None:
+			logger.info("No record for {0}; it will be created.".format(domain))
+		else:
+			logger.info("Current record for {0}: {1} (TTL {2}).".
+				format(domain, *records[domain]))
+	# Without TTL bounds, each record keeps its live TTL (or the default
+	# TTL, for records that are created).
+	ttls = {}
+	for d in domains:
+		live = records[d][1] or min_ttl or default_ttl
+		ttls[d] = ttl_policy(min_ttl or live, max_ttl or live, live, now)
+	flaps = debouncer(None, observations, window)
 	logger.info("Initialization successful.")
 
+	(cur_ip, change_pending, change_id, submitted) = ("unknown", False, "", {})
+	stats = {"cycles": 0, "updates": 0, "errors": 0, "timeouts": 0}
+
+	# The first check is made right away. Watchdog pings are sent on every
+	# wakeup, so the watchdog timer only fires if nothing else does. The
+	# ping is sent right before the work of the cycle, so the time between
+	# two pings is at most one cycle plus half of the watchdog timeout.
+	wheel.schedule("check", 0)
+	wheel.schedule("reconcile", reconcile, slack)
+	ping = notify.watchdog_interval()
+
+	# Timeouts are counted separately from other errors. After a timeout,
+	# the timed-out work is retried right away, unless it was already being
+	# retried.
+	retrying = set()
+	def failed(what, e, timer, period):
+		if isinstance(e, TimeoutError):
+			stats["timeouts"] += 1
+			logger.warning("Timed out trying to {0}: {1}".format(what, e))
+		else:
+			stats["errors"] += 1
+			logger.warning("Failed to {0}: {1}".format(what, e))
+			logger.warning(traceback.format_exc())
+		if isinstance(e, TimeoutError) and not timer in retrying:
+			retrying.add(timer)
+			wheel.schedule(timer, 0)
+			logger.warning("Next attempt right away.")
+		else:
+			retrying.discard(timer)
+			wheel.schedule(timer, period, slack)
+			logger.warning("Next attempt in {0:.0f} seconds.".format(period))
+
+	def succeeded(timer, period):
+		retrying.discard(timer)
+		wheel.schedule(timer, period, slack)
+
 	while True:
-		time.sleep(recheck)
+		stats["cur-ip"] = cur_ip
+		stats["set-ip"] = ", ".join(sorted(set(str(ip) for (ip, _) in records.values())))
+		stats["wakeups"] = wheel.wakeups_per_hour()
+		notify.status(format_stats(stats))
+		if ping > 0:
+			wheel.schedule("watchdog", ping / 2, ping / 2)
+
+		fired = wheel.wait()
+		if ping > 0:
+			notify.watchdog()
+		if fired == ["watchdog"]:
+			continue
+		stats["cycles"] += 1
+		limit = deadline(cycle_deadline)
 
-		# If we already have a pending change, wait for it to commit
-		# before making another request.
-		if change_pending:
+		# Records whose address changes while a change is pending are
+		# picked up together by the next batch, once it is committed.
+		if "commit" in fired:
 			try:
-				if not change_committed(change_id):
+				if not backend.committed(change_id, limit.budget("commit")):
 					logger.info("Previous change not yet committed.")
-					logger.info("Next check in 5 minutes.")
-					continue
+					succeeded("commit", recheck)
 				else:
 					logger.info("Previous change committed.")
+					retrying.discard("commit")
 					change_pending = False
-					set_ip = cur_ip
+					records.update(submitted)
+					if any(ip != flaps.stable_ip for (ip, _) in records.values()):
+						wheel.schedule("check", 0)
 			except Exception as e:
-				logger.warning("Failed to get change status: {0}".format(e))
-				logger.warning(traceback.format_exc())
-				logger.warning("Next attempt in 5 minutes.")
-				continue
+				failed("get change status", e, "commit", recheck)
+
+		# The records are otherwise only read at startup, so re-read
+		# them occasionally to catch edits made outside of the service.
+		# Any differences are fixed by the next check.
+		if "reconcile" in fired and change_pending:
+			wheel.schedule("reconcile", recheck, slack)
+		elif "reconcile" in fired:
+			logger.info("Averaging {0:.1f} wakeups per hour.".
+				format(wheel.wakeups_per_hour()))
+			try:
+				live = backend.read_records(domains, upsert,
+					limit.budget("reconcile"))
+				for domain in domains:
+					if live[domain] != records[domain]:
+						logger.warning("Record for {0} was changed "
+							"outside of the service: expected {1}, "
+							"found {2}.".format(domain,
+							records[domain], live[domain]))
+				records = live
+				succeeded("reconcile", reconcile)
+			except Exception as e:
+				failed("reconcile records", e, "reconcile", reconcile)
+
+		if not "check" in fired:
+			continue
 
 		# Try to get the public IP.
 		try:
-			cur_ip = get_public_ip()
+			cur_ip = sources.get(limit.budget("address"))
 		except Exception as e:
-			logger.warning("Failed to get public IP: {0}".format(e))
-			logger.warning(traceback.format_exc())
-			logger.warning("Next attempt in 5 minutes.")
+			failed("get public IP", e, "check", recheck)
 			continue
 
-		# Try to update the public IP.
-		if set_ip != cur_ip:
+		# Work out which records need a new address or TTL.
+		now = wheel.now()
+		ip = flaps.observe(cur_ip, now)
+		updates = []
+		for domain in domains:
+			# A flap that has only just been observed counts toward the
+			# volatility of the address, even if it is later cancelled.
+			if flaps.candidate is not None and flaps.count == 1:
+				ttls[domain].flapped(now)
+
+			(old_ip, old_ttl) = records[domain]
+			unstable = flaps.expecting(now) or old_ip != ip
+			ttl = ttls[domain].target(now, unstable)
+			if old_ip != ip or ttls[domain].should_update(old_ttl, ttl):
+				updates.append((domain, records[domain], (ip, ttl)))
+				if old_ttl is not None and ttl != old_ttl:
+					logger.info("Changing TTL of {0} from {1} to {2}.".
+						format(domain, old_ttl, ttl))
+
+		if len(updates) != 0 and change_pending:
+			logger.info("Holding back {0} updates until the previous "
+				"change is committed.".format(len(updates)))
+		elif len(updates) != 0:
 			try:
-				change_id = update_record(domain, zone_id, set_ip, cur_ip)
-				change_pending = True
-				logger.info("Successfully updated record.")
-				logger.info("Next check in 5 minutes.")
+				(insync, change_id) = backend.write_batch(updates, upsert,
+					limit.budget("update"))
+				submitted = {d: new for (d, _, new) in updates}
+				# Backends that apply changes synchronously have nothing
+				# to wait for.
+				if insync:
+					records.update(submitted)
+				else:
+					change_pending = True
+					wheel.schedule("commit", recheck, slack)
+				for (domain, (old_ip, _), (new_ip, _)) in updates:
+					if old_ip != new_ip:
+						ttls[domain].changed(now)
+				stats["updates"] += 1
+				logger.info("Successfully updated {0} records.".
+					format(len(updates)))
 			except Exception as e:
-				logger.warning("Failed to update record: {0}".format(e))
-				logger.warning(traceback.format_exc())
-				logger.warning("Next attempt in 5 minutes.")
+				# The change may have been submitted before the
+				# command was killed, so re-read the records.
+				if isinstance(e, TimeoutError):
+					wheel.schedule("reconcile", 0)
+				failed("update records", e, "check", recheck)
 				continue
-		else:
+		elif ip == cur_ip:
 			logger.info("Public IP has not changed.")
-			logger.info("Next check in 5 minutes.")
+		succeeded("check", recheck)
 
 class aws_dns_service(service):
 	def __init__(self):
 		super(aws_dns_service, self).__init__(service_path, pidfile)
 		self.terminating = False
-		
+		self.in_foreground = False
+		self.notify = notifier()
+
+	"""
+	Runs the daemon in the foreground without forking, for use with
+	`Type=notify` systemd units. Readiness is reported through
+	`NOTIFY_SOCKET` instead of the status pipe, and log messages go to
+	standard error, which is collected by the journal.
+	"""
+	def foreground(self):
+		self.parent = False
+		self.in_foreground = True
+		signal.signal(signal.SIGTERM, self.terminate)
+		self.run()
+
+	def log_status(self, success):
+		if not self.in_foreground:
+			return super(aws_dns_service, self).log_status(success)
+		if success:
+			self.notify.ready()
+		else:
+			self.notify.status("Initialization failed.")
+
+	def usage(self):
+		print(" * Usage: {0} {{start|stop|reload|force-reload|restart|try-restart|status|foreground|sync <file>}}.".
+			format(self.service_path))
+
+	"""
+	Reconciles a hosted zone with the declarative record file given as the
+	second argument (see `read_desired`), and prints a report. The zone is
+	listed once, and the minimal set of changes is submitted in batches
+	that respect the Route 53 limits. The batches are then waited on in
+	parallel. Each `aws` command is killed if it takes longer than
+	`timeout` seconds.
+
+	The AWS credential settings are read from the configuration file, if
+	there is one, and the credentials are resolved once for all of the
+	`aws` commands, as in the daemon.
+	"""
+	def sync(self, commit_timeout=1800, timeout=300):
+		global aws_credentials, aws_profile
+		if len(sys.argv) != 3:
+			self.usage()
+			return exit_failure
+		timings = []
+		t = time.monotonic()
+
+		try:
+			config = json.load(open(conf_file)) if os.path.exists(conf_file) \
+				else {}
+			aws_profile = config.get("aws-profile")
+			if config.get("aws-credentials", "daemon") == "daemon":
+				provider = credential_provider(aws_profile,
+					config.get("sts-endpoint", "https://sts.amazonaws.com"),
+					config.get("sts-region", "us-east-1"))
+				try:
+					provider.start()
+					aws_credentials = provider
+				except unsupported:
+					pass
+		except Exception as e:
+			self.log.log_failure("Failed to resolve AWS credentials: {0}".
+				format(e))
+			return exit_failure
+
+		try:
+			(zone_id, desired, prune) = read_desired(sys.argv[2])
+			existing = get_json(['aws', 'route53', 'list-resource-record-sets',
+				'--hosted-zone-id', zone_id, '--output', 'json'], timeout)
+			existing = existing["ResourceRecordSets"]
+		except Exception as e:
+			self.log.log_failure("Failed to read records: {0}".format(e))
+			return exit_failure
+		timings.append(("read", time.monotonic() - t))
+		t = time.monotonic()
+
+		(changes, unchanged) = diff_records(desired, existing, prune)
+		chunks = chunk_changes(changes)
+		timings.append(("diff", time.monotonic() - t))
+		t = time.monotonic()
+		counts = {a: sum(c["Action"] == a for c in changes) for a in
+			["CREATE", "UPSERT", "DELETE"]}
+		self.log.log_success("{0} record sets in zone, {1} desired: {2} to "
+			"create, {3} to update, {4} to delete, {5} unchanged.".format(
+			len(existing), len(desired), counts["CREATE"], counts["UPSERT"],
+			counts["DELETE"], unchanged))
+
+		# Submit the batches one at a time, since Route 53 throttles
+		# change requests per account.
+		(ids, failed) = ([], 0)
+		for (i, chunk) in enumerate(chunks):
+			try:
+				ids.append(submit_changes(zone_id, chunk, timeout)[1])
+				self.log.log_success("Submitted batch {0}/{1} ({2} changes).".
+					format(i + 1, len(chunks), len(chunk)))
+			except Exception as e:
+				failed += 1
+				self.log.log_failure("Batch {0}/{1} failed: {2}".
+					format(i + 1, len(chunks), e))
+		timings.append(("submit", time.monotonic() - t))
+		t = time.monotonic()
+
+		committed = 0
+		if len(ids) != 0:
+			with ThreadPoolExecutor(max_workers=min(16, len(ids))) as pool:
+				futures = [pool.submit(wait_committed, i, commit_timeout)
+					for i in ids]
+				for f in as_completed(futures):
+					try:
+						f.result()
+						committed += 1
+						self.log.log_success("{0}/{1} batches committed.".
+							format(committed, len(ids)))
+					except Exception as e:
+						failed += 1
+						self.log.log_failure(str(e))
+		timings.append(("commit", time.monotonic() - t))
+
+		self.log.log_success("{0} changes in {1} batches: {2} committed, "
+			"{3} failed.".format(len(changes), len(chunks), committed, failed))
+		self.log.log_success("Timings: {0}; total {1:.2f} s.".format(
+			", ".join("{0} {1:.2f} s".format(*p) for p in timings),
+			sum(d for (_, d) in timings)))
+		return exit_success if failed == 0 else exit_failure
+
+	"""
+	Returns the numeric configuration value for `key`, or `default` if the
+	key is absent. Terminates the daemon if the value is invalid.
+	"""
+	def config_number(self, config, key, default, integer=False, positive=True):
+		logger = logging.getLogger("aws_dns")
+		if not key in config:
+			return default
+
+		value = config[key]
+		name = key.replace("-", " ").capitalize()
+		if integer and type(value) != int:
+			logger.critical("{0} must be an integer.".format(name))
+			self.log_status(False)
+			sys.exit(1)
+		if not (type(value) == float or type(value) == int):
+			logger.critical("{0} must be a number.".format(name))
+			self.log_status(False)
+			sys.exit(1)
+		if positive and value <= 0:
+			logger.critical("{0} must be positive.".format(name))
+			self.log_status(False)
+			sys.exit(1)
+		if value < 0:
+			logger.critical("{0} must be non-negative.".format(name))
+			self.log_status(False)
+			sys.exit(1)
+		return value
+
+	"""
+	Returns the DNS backend of kind `kind` described by `config`. Terminates
+	the daemon if its settings are invalid.
+	"""
+	def make_backend(self, config, kind):
+		logger = logging.getLogger("aws_dns")
+		if kind == "route53":
+			return route53_backend(config["hosted-zone-id"])
+
+		# TSIG signing is optional, but servers should not accept
+		# unsigned updates from the internet.
+		keys = ["tsig-key-name", "tsig-secret", "tsig-algorithm", "dns-protocol"]
+		for key in keys:
+			if key in config and type(config[key]) != str:
+				logger.critical("{0} must be a string.".
+					format(key.replace("-", " ").capitalize()))
+				self.log_status(False)
+				sys.exit(1)
+		if ("tsig-key-name" in config) != ("tsig-secret" in config):
+			logger.critical("TSIG key name and secret must be given together.")
+			self.log_status(False)
+			sys.exit(1)
+		protocol = config.get("dns-protocol", "udp")
+		if not protocol in ["udp", "tcp"]:
+			logger.critical("DNS protocol must be \"udp\" or \"tcp\".")
+			self.log_status(False)
+			sys.exit(1)
+
+		key = None
+		if "tsig-key-name" in config:
+			try:
+				key = tsig_key(config["tsig-key-name"], config["tsig-secret"],
+					config.get("tsig-algorithm", "hmac-sha256"))
+			except Exception as e:
+				logger.critical("Invalid TSIG key: {0}".format(e))
+				self.log_status(False)
+				sys.exit(1)
+		port = self.config_number(config, "dns-port", 53, integer=True)
+		return rfc2136_backend(config["dns-server"], config["dns-zone"], key,
+			port, protocol)
+
 	def run(self):
 		# Set up the logging.
-		fmt = "%(asctime)s :: %(levelname)s :: %(funcName)s, line %(lineno)s :: %(message)s"
 		logger = logging.getLogger("aws_dns")
 		logger.setLevel(logging.INFO)
-		h = logging.handlers.RotatingFileHandler(logfile, maxBytes=2**30, backupCount=5)
+		if self.in_foreground:
+			# The journal already records the time.
+			fmt = "%(levelname)s :: %(funcName)s, line %(lineno)s :: %(message)s"
+			h = logging.StreamHandler(sys.stderr)
+		else:
+			fmt = "%(asctime)s :: %(levelname)s :: %(funcName)s, line %(lineno)s :: %(message)s"
+			h = logging.handlers.RotatingFileHandler(logfile, maxBytes=2**30, backupCount=5)
 		f = logging.Formatter(fmt)
 		h.setFormatter(f)
 		logger.addHandler(h)
@@ -218,51 +921,162 @@ class aws_dns_service(service):
 			self.log_status(False)
 			sys.exit(1)
 
-		for key in ["domain-name", "hosted-zone-id"]:
+		# Records are kept in Route 53 by default, or on an authoritative
+		# server of our own that accepts DNS UPDATE.
+		kind = config.get("backend", "route53")
+		if not kind in ["route53", "rfc2136"]:
+			logger.critical("Backend must be \"route53\" or \"rfc2136\".")
+			self.log_status(False)
+			sys.exit(1)
+
+		required = {"route53": ["hosted-zone-id"], "rfc2136": ["dns-server",
+			"dns-zone"]}[kind]
+		for key in ["domain-name"] + required:
 			if not key in config:
 				logger.critical("Configuration missing key \"{0}\"".format(key))
 				self.log_status(False)
 				sys.exit(1)
 
-		(domain, zone_id) = (config["domain-name"], config["hosted-zone-id"])
+		# The domain name can also be a list of names in the same hosted
+		# zone, all of which are pointed at the public IP.
+		domains = config["domain-name"]
+		if type(domains) == str:
+			domains = [domains]
 
-		if type(domain) != str or type(zone_id) != str:
-			logging.critical("Domain and hosted zone ID must be strings.")
+		if type(domains) != list or len(domains) == 0 or \
+			any(type(d) != str for d in domains) or \
+			any(type(config[k]) != str for k in required):
+			logger.critical("Domain, {0} must be strings.".format(", ".join(
+				k.replace("-", " ") for k in required)))
 			self.log_status(False)
 			sys.exit(1)
 
-		if not domain.endswith("."):
-			domain += "."
+		domains = [d if d.endswith(".") else d + "." for d in domains]
+		recheck = self.config_number(config, "recheck-time", 300)
 
-		if "recheck-time" in config:
-			recheck = config["recheck-time"]
-			if not (type(recheck) == float or type(recheck) == int):
-				logging.critical("Recheck time must be a number.")
-				self.log_status(False)
-				sys.exit(1)
-			if recheck <= 0:
-				logging.critical("Recheck time must be positive.")
+		# By default, a new public IP is accepted as soon as it is
+		# observed. If only the stability window is given, the number of
+		# observations does not matter.
+		observations = self.config_number(config, "stable-observations",
+			None, integer=True)
+		window = self.config_number(config, "stable-time", None,
+			positive=False)
+
+		# If either bound is given, the TTL of each record is adapted to
+		# how often its address changes. Otherwise, the live TTL is kept.
+		adaptive = "min-ttl" in config or "max-ttl" in config
+		min_ttl = self.config_number(config, "min-ttl",
+			60 if adaptive else None, integer=True)
+		max_ttl = self.config_number(config, "max-ttl",
+			3600 if adaptive else None, integer=True)
+		if adaptive and min_ttl > max_ttl:
+			logger.critical("Min TTL must not exceed max TTL.")
+			self.log_status(False)
+			sys.exit(1)
+
+		# In "upsert" mode, records are written blindly from the cached
+		# state, without depending on the old value.
+		write_mode = config.get("write-mode", "delete-create")
+		if not write_mode in ["delete-create", "upsert"]:
+			logger.critical("Write mode must be \"delete-create\" or \"upsert\".")
+			self.log_status(False)
+			sys.exit(1)
+		reconcile = self.config_number(config, "reconcile-time", 3600)
+
+		# The local address sources are tried before the HTTP echo
+		# service, since they do not depend on a third party.
+		names = config.get("address-sources", ["nat-pmp", "imds", "http"])
+		gateway = config.get("nat-pmp-gateway")
+		factories = {
+			"nat-pmp" : lambda: nat_pmp_source(gateway),
+			"imds"    : imds_source,
+			"http"    : http_source
+		}
+		if type(names) != list or len(names) == 0 or \
+			any(not n in factories for n in names):
+			logger.critical("Address sources must be a list of \"nat-pmp\", "
+				"\"imds\", and \"http\".")
+			self.log_status(False)
+			sys.exit(1)
+		if gateway is not None and type(gateway) != str:
+			logger.critical("NAT-PMP gateway must be a string.")
+			self.log_status(False)
+			sys.exit(1)
+		sources = source_chain([factories[n]() for n in names])
+
+		backend = self.make_backend(config, kind)
+
+		# Resolve the AWS credentials once, instead of in every `aws`
+		# process. Credential sources that are not supported here are
+		# left to the `aws` command.
+		cred_mode = config.get("aws-credentials", "daemon") if kind == "route53" \
+			else "cli"
+		if not cred_mode in ["daemon", "cli"]:
+			logger.critical("AWS credentials must be \"daemon\" or \"cli\".")
+			self.log_status(False)
+			sys.exit(1)
+		for key in ["aws-profile", "sts-endpoint", "sts-region"]:
+			if key in config and type(config[key]) != str:
+				logger.critical("{0} must be a string.".
+					format(key.replace("-", " ").capitalize()))
 				self.log_status(False)
 				sys.exit(1)
-		else:
-			recheck = 300
+		global aws_profile
+		aws_profile = config.get("aws-profile")
+		provider = None
+		if cred_mode == "daemon":
+			provider = credential_provider(aws_profile,
+				config.get("sts-endpoint", "https://sts.amazonaws.com"),
+				config.get("sts-region", "us-east-1"))
+
+		# Each check must finish within this many seconds. Under systemd,
+		# a check starts up to half of `WatchdogSec` after the previous
+		# ping, so the deadline must be below the other half. By default,
+		# it is half of that again, to leave room for the check's own
+		# overhead.
+		ping = self.notify.watchdog_interval()
+		cycle_deadline = self.config_number(config, "cycle-deadline",
+			ping / 2 if ping > 0 else 30)
+		if ping > 0 and cycle_deadline >= ping:
+			logger.warning("Cycle deadline of {0} seconds is not below half "
+				"of WatchdogSec ({1:.0f} seconds); a slow check may trigger "
+				"the watchdog.".format(cycle_deadline, ping))
 
+		# How late periodic work may be made, so that it can share a
+		# wakeup with other work.
+		slack = self.config_number(config, "timer-slack", recheck / 10,
+			positive=False)
+
+		# The credentials are resolved after readiness is reported, so that
+		# a slow or unreachable STS neither delays startup nor stops the
+		# daemon.
 		self.log_status(True)
-		start(domain, zone_id, recheck)
+		if provider is not None:
+			global aws_credentials
+			aws_credentials = resolve_credentials(provider, self.notify)
+		start(domains, backend, recheck, self.notify, sources, observations,
+			window, min_ttl, max_ttl, write_mode == "upsert", reconcile,
+			cycle_deadline, slack)
 
 	def terminate(self, signum, frame):
 		logger = logging.getLogger("aws_dns")
 		logger.info("Stopping service.")
+		self.notify.stopping()
+		if aws_credentials is not None:
+			aws_credentials.stop()
 		sys.exit(0)
-	
-s = aws_dns_service()
-r = {
-	"start"        : s.start,
-	"stop"         : s.stop,
-	"restart"      : s.restart,
-	"try-restart"  : s.try_restart,
-	"reload"       : s.reload,
-	"force-reload" : s.force_reload,
-	"status"       : s.status
-}.get(sys.argv[1] if len(sys.argv) > 1 else "usage", s.usage)()
-sys.exit(r)
+
+if __name__ == "__main__":
+	s = aws_dns_service()
+	r = {
+		"start"        : s.start,
+		"stop"         : s.stop,
+		"restart"      : s.restart,
+		"try-restart"  : s.try_restart,
+		"reload"       : s.reload,
+		"force-reload" : s.force_reload,
+		"status"       : s.status,
+		"foreground"   : s.foreground,
+		"sync"         : s.sync
+	}.get(sys.argv[1] if len(sys.argv) > 1 else "usage", s.usage)()
+	sys.exit(r)
@@ -0,0 +1,317 @@
+"""
+File Name: credentials.py
+
+# Introduction
+
+This file resolves AWS credentials inside the daemon, so that the `aws`
+processes spawned for each Route 53 call do not have to. Without it, every call
+re-reads `~/.aws/credentials` and `~/.aws/config`, and repeats any `AssumeRole`
+call from scratch. The resolved credentials are passed to the `aws` processes
+through the standard environment variables.
+
+The following sources are supported, in the same order of precedence as the
+`aws` command:
+
+  - Static keys in the `AWS_ACCESS_KEY_ID`, `AWS_SECRET_ACCESS_KEY`, and
+    `AWS_SESSION_TOKEN` environment variables.
+  - Static keys in a profile (`aws_access_key_id`, `aws_secret_access_key`,
+    and `aws_session_token`).
+  - Profiles with `role_arn`, whose source credentials are given by
+    `source_profile` (which may itself assume a role) or by
+    `credential_source = Environment`. The optional `external_id`,
+    `role_session_name`, and `duration_seconds` keys are honored.
+
+Other kinds of profiles (e.g. SSO, `credential_process`, MFA, or instance
+roles) raise `unsupported`, in which case the caller should leave credential
+resolution to the `aws` command.
+
+Temporary credentials are cached in memory, and refreshed by a background
+thread well before they expire, so that Route 53 calls never wait on STS.
+
+# Testing
+
+The STS endpoint can be passed explicitly, so that a local HTTP server can
+stand in for STS. The server should answer `POST /` with an `AssumeRole`
+response document.
+"""
+
+import os
+import hmac
+import time
+import hashlib
+import logging
+import threading
+import configparser
+import urllib.parse
+import urllib3
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone
+from collections import namedtuple
+
+"""
+`expiry` is the expiration time as a UNIX timestamp, or `None` for static
+credentials.
+"""
+Credentials = namedtuple("Credentials", ["access_key", "secret_key", "token",
+	"expiry"])
+
+class unsupported(Exception):
+	pass
+
+"""
+Returns the settings for `profile`, merged from the config and credentials
+files. Keys in the credentials file take precedence.
+"""
+def read_profile(profile, config_file=None, credentials_file=None):
+	home = os.path.expanduser("~")
+	config_file = config_file or os.environ.get("AWS_CONFIG_FILE",
+		os.path.join(home, ".aws", "config"))
+	credentials_file = credentials_file or os.environ.get(
+		"AWS_SHARED_CREDENTIALS_FILE", os.path.join(home, ".aws", "credentials"))
+
+	settings = {}
+	config = configparser.RawConfigParser()
+	config.read(config_file)
+	section = profile if profile == "default" else "profile " + profile
+	if config.has_section(section):
+		settings.update(config.items(section))
+
+	creds = configparser.RawConfigParser()
+	creds.read(credentials_file)
+	if creds.has_section(profile):
+		settings.update(creds.items(profile))
+
+	# The `aws` command may still find credentials elsewhere, e.g. from the
+	# instance metadata service.
+	if len(settings) == 0:
+		raise unsupported("Profile {0} not found.".format(profile))
+	return settings
+
+def from_environment():
+	if not "AWS_ACCESS_KEY_ID" in os.environ or \
+		not "AWS_SECRET_ACCESS_KEY" in os.environ:
+		return None
+	return Credentials(os.environ["AWS_ACCESS_KEY_ID"],
+		os.environ["AWS_SECRET_ACCESS_KEY"],
+		os.environ.get("AWS_SESSION_TOKEN"), None)
+
+"""
+Computes the AWS Signature Version 4 `Authorization` header for a request, and
+adds it to `headers`, along with the other headers that need to be signed.
+"""
+def sign_request(method, url, body, headers, creds, region, service, now=None):
+	now = now or datetime.now(timezone.utc)
+	amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+	date = amz_date[:8]
+	parts = urllib.parse.urlsplit(url)
+
+	headers["Host"] = parts.netloc
+	headers["X-Amz-Date"] = amz_date
+	if creds.token is not None:
+		headers["X-Amz-Security-Token"] = creds.token
+
+	canonical_headers = sorted((k.lower(), " ".join(v.split()))
+		for (k, v) in headers.items())
+	signed_headers = ";".join(k for (k, _) in canonical_headers)
+	canonical_request = "\n".join([
+		method,
+		parts.path or "/",
+		parts.query,
+		"".join("{0}:{1}\n".format(k, v) for (k, v) in canonical_headers),
+		signed_headers,
+		hashlib.sha256(body).hexdigest()
+	])
+
+	scope = "{0}/{1}/{2}/aws4_request".format(date, region, service)
+	string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+		hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()])
+
+	key = ("AWS4" + creds.secret_key).encode("utf-8")
+	for part in [date, region, service, "aws4_request"]:
+		key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+	signature = hmac.new(key, string_to_sign.encode("utf-8"),
+		hashlib.sha256).hexdigest()
+
+	headers["Authorization"] = "AWS4-HMAC-SHA256 Credential={0}/{1}, " \
+		"SignedHeaders={2}, Signature={3}".format(creds.access_key, scope,
+		signed_headers, signature)
+	return headers
+
+"""
+Calls `AssumeRole` using the source credentials `creds`, and returns the
+temporary credentials.
+"""
+def assume_role(http, creds, role_arn, session_name, endpoint, region,
+	duration=3600, external_id=None):
+	params = {
+		"Action"          : "AssumeRole",
+		"Version"         : "2011-06-15",
+		"RoleArn"         : role_arn,
+		"RoleSessionName" : session_name,
+		"DurationSeconds" : str(duration)
+	}
+	if external_id is not None:
+		params["ExternalId"] = external_id
+
+	body = urllib.parse.urlencode(params).encode("utf-8")
+	headers = {"Content-Type": "application/x-www-form-urlencoded; charset=utf-8"}
+	sign_request("POST", endpoint + "/", body, headers, creds, region, "sts")
+	r = http.request("POST", endpoint + "/", body=body, headers=headers)
+
+	try:
+		doc = ElementTree.fromstring(r.data)
+	except ElementTree.ParseError:
+		raise Exception("Bad STS response ({0}): {1}".format(r.status, r.data))
+	if r.status != 200:
+		message = doc.find(".//{*}Message")
+		raise Exception("AssumeRole for {0} failed ({1}): {2}".format(role_arn,
+			r.status, message.text if message is not None else r.data))
+
+	fields = {}
+	for key in ["AccessKeyId", "SecretAccessKey", "SessionToken", "Expiration"]:
+		node = doc.find(".//{*}Credentials/{*}" + key)
+		if node is None:
+			raise Exception("No key {0} in STS response: {1}".format(key, r.data))
+		fields[key] = node.text.strip()
+
+	expiry = datetime.fromisoformat(
+		fields["Expiration"].replace("Z", "+00:00")).timestamp()
+	return Credentials(fields["AccessKeyId"], fields["SecretAccessKey"],
+		fields["SessionToken"], expiry)
+
+"""
+Summary of parameters:
+
+  - `profile` is the name of the profile to use if the credentials are not
+    given by the environment. By default, the value of `AWS_PROFILE` is used,
+    or `default` if it is not set.
+  - `sts_endpoint` and `sts_region` determine where `AssumeRole` requests are
+    sent, and how they are signed.
+  - `refresh_margin` is the number of seconds before expiry at which
+    temporary credentials are refreshed. It is capped at a quarter of the
+    lifetime of the credentials, so that short-lived credentials are not
+    refreshed as soon as they are obtained.
+  - `timeout` is the floating-point number of seconds to wait for STS.
+"""
+class credential_provider:
+	def __init__(self, profile=None, sts_endpoint="https://sts.amazonaws.com",
+		sts_region="us-east-1", refresh_margin=900, timeout=10,
+		config_file=None, credentials_file=None):
+		self.profile          = profile or os.environ.get("AWS_PROFILE", "default")
+		self.sts_endpoint     = sts_endpoint.rstrip("/")
+		self.sts_region       = sts_region
+		self.refresh_margin   = refresh_margin
+		self.config_file      = config_file
+		self.credentials_file = credentials_file
+		self.http             = urllib3.PoolManager(
+			timeout=urllib3.Timeout(total=timeout), retries=False)
+		self.lock             = threading.Lock()
+		self.stopped          = threading.Event()
+		self.creds            = None
+		self.obtained         = None
+		self.thread           = None
+
+	def resolve_profile(self, profile, seen):
+		if profile in seen:
+			raise Exception("Cycle in source profiles: {0}".format(profile))
+		seen.append(profile)
+		s = read_profile(profile, self.config_file, self.credentials_file)
+
+		if "role_arn" in s:
+			for key in ["mfa_serial", "web_identity_token_file"]:
+				if key in s:
+					raise unsupported("Profile {0} uses {1}.".
+						format(profile, key))
+			if "source_profile" in s:
+				source = self.resolve_profile(s["source_profile"], seen)
+			elif s.get("credential_source") == "Environment":
+				source = from_environment()
+				if source is None:
+					raise Exception("No credentials in environment.")
+			else:
+				raise unsupported("Profile {0} has no supported source "
+					"credentials.".format(profile))
+			return assume_role(self.http, source, s["role_arn"],
+				s.get("role_session_name", "aws_dns-{0}".format(os.getpid())),
+				self.sts_endpoint, self.sts_region,
+				int(s.get("duration_seconds", 3600)), s.get("external_id"))
+
+		if "aws_access_key_id" in s and "aws_secret_access_key" in s:
+			return Credentials(s["aws_access_key_id"],
+				s["aws_secret_access_key"], s.get("aws_session_token"), None)
+		raise unsupported("Profile {0} has no supported credentials.".
+			format(profile))
+
+	"""
+	Resolves the credentials from scratch.
+	"""
+	def resolve(self):
+		creds = from_environment()
+		if creds is None:
+			creds = self.resolve_profile(self.profile, [])
+		return creds
+
+	"""
+	Resolves the credentials for the first time, and starts the background
+	refresh thread if they are temporary. Errors are raised to the caller.
+	"""
+	def start(self):
+		self.creds = self.resolve()
+		self.obtained = time.time()
+		if self.creds.expiry is not None:
+			self.thread = threading.Thread(target=self.refresh_loop,
+				name="credential-refresh", daemon=True)
+			self.thread.start()
+
+	"""
+	Refreshes the credentials before they expire. Failed refreshes are
+	retried with exponential backoff, from `min_retry` to `max_retry`
+	seconds, while the old credentials are kept.
+	"""
+	def refresh_loop(self, min_retry=10, max_retry=300):
+		logger = logging.getLogger("aws_dns")
+		retry = None
+		while True:
+			if retry is None:
+				with self.lock:
+					(expiry, obtained) = (self.creds.expiry, self.obtained)
+				margin = min(self.refresh_margin, (expiry - obtained) / 4)
+				wait = max(min_retry, expiry - margin - time.time())
+			else:
+				wait = retry
+			if self.stopped.wait(wait):
+				return
+			try:
+				creds = self.resolve()
+				with self.lock:
+					(self.creds, self.obtained) = (creds, time.time())
+				retry = None
+				logger.info("Refreshed AWS credentials; they expire in "
+					"{0:.0f} seconds.".format(creds.expiry - time.time()))
+			except Exception as e:
+				retry = min_retry if retry is None else min(2 * retry, max_retry)
+				logger.warning("Failed to refresh AWS credentials: {0}".
+					format(e))
+				logger.warning("Next attempt in {0:.0f} seconds.".format(retry))
+
+	def get(self):
+		with self.lock:
+			return self.creds
+
+	"""
+	Returns a copy of the environment in which the `aws` command uses the
+	cached credentials instead of resolving its own.
+	"""
+	def env(self):
+		creds = self.get()
+		env = dict(os.environ)
+		for key in ["AWS_PROFILE", "AWS_DEFAULT_PROFILE", "AWS_SESSION_TOKEN"]:
+			env.pop(key, None)
+		env["AWS_ACCESS_KEY_ID"] = creds.access_key
+		env["AWS_SECRET_ACCESS_KEY"] = creds.secret_key
+		if creds.token is not None:
+			env["AWS_SESSION_TOKEN"] = creds.token
+		return env
+
+	def stop(self):
+		self.stopped.set()
@@ -0,0 +1,377 @@
+"""
+File Name: dns_update.py
+
+# Introduction
+
+This file contains a DNS backend for `aws_dns` that updates records on an
+authoritative server that we run ourselves, using DNS UPDATE (RFC 2136) signed
+with TSIG (RFC 8945). Unlike Route 53, the server applies an update before
+answering, so there is no pending change to wait for.
+
+Like the Route 53 backend in `aws_dns.py`, the backend provides the following
+methods:
+
+  - `read_records(domains, allow_missing, timeout)` returns a dictionary
+    mapping each domain to the `(address, TTL)` pair of its A record.
+  - `write_batch(updates, upsert, timeout)` applies a list of `(domain, old,
+    new)` updates atomically, and returns a pair indicating whether the change
+    is already committed and its ID.
+  - `committed(change_id, timeout)` returns true once the change is visible.
+
+Messages are sent over UDP, and retried over TCP if the response is truncated.
+TCP can also be used exclusively.
+
+# Testing
+
+The server address and port can be passed explicitly, so that a local stub
+server can stand in for the authoritative server. `parse_message` and
+`tsig_key.verify` can be used by the stub to decode and check the requests.
+"""
+
+import time
+import hmac
+import base64
+import socket
+import struct
+import secrets
+import hashlib
+from collections import namedtuple
+
+TYPE_A    = 1
+TYPE_SOA  = 6
+TYPE_TSIG = 250
+CLASS_IN   = 1
+CLASS_NONE = 254
+CLASS_ANY  = 255
+OPCODE_UPDATE = 5
+
+rcodes = {
+	1: "FORMERR", 2: "SERVFAIL", 3: "NXDOMAIN", 4: "NOTIMP", 5: "REFUSED",
+	6: "YXDOMAIN", 7: "YXRRSET", 8: "NXRRSET", 9: "NOTAUTH", 10: "NOTZONE",
+	16: "BADSIG", 17: "BADKEY", 18: "BADTIME"
+}
+
+algorithms = {
+	"hmac-md5.sig-alg.reg.int." : hashlib.md5,
+	"hmac-sha1."                : hashlib.sha1,
+	"hmac-sha224."              : hashlib.sha224,
+	"hmac-sha256."              : hashlib.sha256,
+	"hmac-sha384."              : hashlib.sha384,
+	"hmac-sha512."              : hashlib.sha512
+}
+
+"""
+`start` is the offset of the record in the message, and `rdata_start` is the
+offset of its data.
+"""
+Record = namedtuple("Record", ["name", "type", "cls", "ttl", "rdata", "start",
+	"rdata_start"])
+Message = namedtuple("Message", ["id", "flags", "questions", "answers",
+	"authority", "additional"])
+
+def absolute(name):
+	return name if name.endswith(".") else name + "."
+
+def encode_name(name):
+	labels = [l for l in name.rstrip(".").split(".") if len(l) != 0]
+	return b"".join(bytes([len(l)]) + l.encode("ascii") for l in labels) + b"\0"
+
+def encode_record(name, type, cls, ttl, rdata):
+	return encode_name(name) + struct.pack("!HHIH", type, cls, ttl,
+		len(rdata)) + rdata
+
+def encode_header(id, flags, counts):
+	return struct.pack("!HHHHHH", id, flags, *counts)
+
+"""
+Reads a possibly compressed name starting at `offset`, and returns it along
+with the offset just past it.
+"""
+def read_name(data, offset):
+	(labels, end, jumps) = ([], None, 0)
+	while True:
+		n = data[offset]
+		if n & 0xc0 == 0xc0:
+			if end is None:
+				end = offset + 2
+			jumps += 1
+			if jumps > 64:
+				raise Exception("Compression loop in message.")
+			offset = struct.unpack("!H", data[offset:offset + 2])[0] & 0x3fff
+		elif n == 0:
+			name = ".".join(labels) + "."
+			return (name, end if end is not None else offset + 1)
+		else:
+			labels.append(data[offset + 1:offset + 1 + n].decode("ascii"))
+			offset += 1 + n
+
+def parse_message(data):
+	if len(data) < 12:
+		raise Exception("Short DNS message.")
+	(id, flags, qd, an, ns, ar) = struct.unpack("!HHHHHH", data[:12])
+	offset = 12
+
+	questions = []
+	for _ in range(qd):
+		(name, offset) = read_name(data, offset)
+		(type, cls) = struct.unpack("!HH", data[offset:offset + 4])
+		questions.append((name, type, cls))
+		offset += 4
+
+	sections = []
+	for count in [an, ns, ar]:
+		records = []
+		for _ in range(count):
+			start = offset
+			(name, offset) = read_name(data, offset)
+			(type, cls, ttl, length) = struct.unpack("!HHIH",
+				data[offset:offset + 10])
+			offset += 10
+			records.append(Record(name, type, cls, ttl,
+				data[offset:offset + length], start, offset))
+			offset += length
+		sections.append(records)
+	return Message(id, flags, questions, *sections)
+
+"""
+Summary of parameters:
+
+  - `name` is the name of the key, as configured on the server.
+  - `secret` is the base64-encoded shared secret.
+  - `algorithm` is the name of the HMAC algorithm, e.g. `hmac-sha256`.
+  - `fudge` is the permitted clock skew in seconds.
+"""
+class tsig_key:
+	def __init__(self, name, secret, algorithm="hmac-sha256", fudge=300):
+		self.name      = absolute(name).lower()
+		self.secret    = base64.b64decode(secret)
+		self.algorithm = absolute(algorithm).lower()
+		self.fudge     = fudge
+		if self.algorithm == "hmac-md5.":
+			self.algorithm = "hmac-md5.sig-alg.reg.int."
+		if not self.algorithm in algorithms:
+			raise Exception("Unsupported TSIG algorithm: {0}".format(algorithm))
+
+	"""
+	Returns the TSIG variables that are covered by the MAC, in addition to
+	the message itself.
+	"""
+	def variables(self, time_signed, error=0, other=b""):
+		return encode_name(self.name) + struct.pack("!HI", CLASS_ANY, 0) + \
+			encode_name(self.algorithm) + \
+			struct.pack("!HIHHH", time_signed >> 32, time_signed & 0xffffffff,
+			self.fudge, error, len(other)) + other
+
+	def mac(self, data):
+		return hmac.new(self.secret, data, algorithms[self.algorithm]).digest()
+
+	"""
+	Appends a TSIG record to `message`, and returns the signed message along
+	with its MAC, which is needed to verify the response. `request_mac` is
+	given when signing a response.
+	"""
+	def sign(self, message, request_mac=b"", time_signed=None):
+		time_signed = int(time.time()) if time_signed is None else time_signed
+		prefix = struct.pack("!H", len(request_mac)) + request_mac \
+			if len(request_mac) != 0 else b""
+		mac = self.mac(prefix + message + self.variables(time_signed))
+
+		id = message[:2]
+		rdata = encode_name(self.algorithm) + \
+			struct.pack("!HIHH", time_signed >> 32, time_signed & 0xffffffff,
+			self.fudge, len(mac)) + mac + id + struct.pack("!HH", 0, 0)
+		arcount = struct.unpack("!H", message[10:12])[0] + 1
+		signed = message[:10] + struct.pack("!H", arcount) + message[12:] + \
+			encode_record(self.name, TYPE_TSIG, CLASS_ANY, 0, rdata)
+		return (signed, mac)
+
+	"""
+	Checks the TSIG record at the end of the message `data`, which was
+	parsed into `msg`. Raises an exception if the record is missing or
+	invalid, or reports an error.
+	"""
+	def verify(self, data, msg, request_mac=b""):
+		if len(msg.additional) == 0 or msg.additional[-1].type != TYPE_TSIG:
+			raise Exception("Response is not signed.")
+		tsig = msg.additional[-1]
+		if tsig.name.lower() != self.name:
+			raise Exception("Response signed with unknown key {0}.".
+				format(tsig.name))
+
+		(algorithm, offset) = read_name(data, tsig.rdata_start)
+		(high, low, fudge, size) = struct.unpack("!HIHH", data[offset:offset + 10])
+		offset += 10
+		mac = data[offset:offset + size]
+		(original_id, error, other_len) = struct.unpack("!HHH",
+			data[offset + size:offset + size + 6])
+		other = data[offset + size + 6:offset + size + 6 + other_len]
+		if error != 0:
+			raise Exception("Server reported TSIG error {0}.".
+				format(rcodes.get(error, error)))
+		if algorithm.lower() != self.algorithm:
+			raise Exception("Response signed with algorithm {0}.".
+				format(algorithm))
+
+		time_signed = (high << 32) | low
+		arcount = len(msg.additional) - 1
+		stripped = struct.pack("!H", original_id) + data[2:10] + \
+			struct.pack("!H", arcount) + data[12:tsig.start]
+		prefix = struct.pack("!H", len(request_mac)) + request_mac \
+			if len(request_mac) != 0 else b""
+		expected = self.mac(prefix + stripped + self.variables(time_signed,
+			error, other))
+		if not hmac.compare_digest(mac, expected):
+			raise Exception("Bad TSIG signature on response.")
+		if abs(time.time() - time_signed) > fudge:
+			raise Exception("TSIG time outside of fudge window.")
+
+"""
+Summary of parameters:
+
+  - `server` and `port` give the address of the authoritative server.
+  - `zone` is the name of the zone that contains the records.
+  - `key` is the `tsig_key` used to sign requests, or `None` to send them
+    unsigned.
+  - `protocol` is either `udp` (with TCP fallback for truncated responses) or
+    `tcp`.
+"""
+class rfc2136_backend:
+	def __init__(self, server, zone, key=None, port=53, protocol="udp"):
+		self.server   = server
+		self.port     = port
+		self.zone     = absolute(zone)
+		self.key      = key
+		self.protocol = protocol
+
+	def exchange_udp(self, message, id, end):
+		sock = socket.socket(socket.AF_INET6 if ":" in self.server else
+			socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			sock.connect((self.server, self.port))
+			sock.send(message)
+			while True:
+				left = end - time.monotonic()
+				if left <= 0:
+					raise socket.timeout()
+				sock.settimeout(left)
+				data = sock.recv(65535)
+				# Ignore stray responses to earlier requests.
+				if len(data) >= 12 and struct.unpack("!H", data[:2])[0] == id:
+					return data
+		finally:
+			sock.close()
+
+	def exchange_tcp(self, message, end):
+		left = end - time.monotonic()
+		if left <= 0:
+			raise socket.timeout()
+		with socket.create_connection((self.server, self.port), left) as sock:
+			sock.sendall(struct.pack("!H", len(message)) + message)
+			def read(n):
+				buf = b""
+				while len(buf) < n:
+					sock.settimeout(max(end - time.monotonic(), 1e-3))
+					chunk = sock.recv(n - len(buf))
+					if len(chunk) == 0:
+						raise Exception("Connection closed by server.")
+					buf += chunk
+				return buf
+			return read(struct.unpack("!H", read(2))[0])
+
+	"""
+	Signs and sends `message`, and returns the verified response. Raises
+	`TimeoutError` if there is no response within `timeout` floating-point
+	seconds.
+	"""
+	def exchange(self, message, timeout=None):
+		end = time.monotonic() + (timeout if timeout is not None else 10)
+		id = struct.unpack("!H", message[:2])[0]
+		request_mac = b""
+		if self.key is not None:
+			(message, request_mac) = self.key.sign(message)
+
+		try:
+			data = None
+			if self.protocol == "udp":
+				data = self.exchange_udp(message, id, end)
+			# Retry over TCP if the response was truncated.
+			if data is None or struct.unpack("!H", data[2:4])[0] & 0x0200:
+				data = self.exchange_tcp(message, end)
+		except socket.timeout:
+			raise TimeoutError("No response from {0} in time.".
+				format(self.server))
+
+		msg = parse_message(data)
+		if msg.id != id:
+			raise Exception("Response ID does not match request.")
+		if self.key is not None:
+			# Servers reject requests that they cannot authenticate
+			# (or that are malformed) without signing the response,
+			# so report the error rather than the missing signature.
+			signed = len(msg.additional) != 0 and \
+				msg.additional[-1].type == TYPE_TSIG
+			rcode = msg.flags & 0xf
+			if not signed and rcode != 0:
+				raise Exception("Request rejected by {0}: {1}".
+					format(self.server, rcodes.get(rcode, rcode)))
+			self.key.verify(data, msg, request_mac)
+		return msg
+
+	def read_records(self, domains, allow_missing=False, timeout=None):
+		end = time.monotonic() + (timeout if timeout is not None else 10)
+		records = {}
+		for domain in domains:
+			id = secrets.randbits(16)
+			query = encode_header(id, 0, [1, 0, 0, 0]) + encode_name(domain) + \
+				struct.pack("!HH", TYPE_A, CLASS_IN)
+			msg = self.exchange(query, end - time.monotonic())
+
+			rcode = msg.flags & 0xf
+			if rcode != 0 and rcode != 3:
+				raise Exception("Query for {0} failed: {1}".
+					format(domain, rcodes.get(rcode, rcode)))
+			answers = [r for r in msg.answers if r.type == TYPE_A and
+				r.name.lower() == domain.lower() and len(r.rdata) == 4]
+			if len(answers) != 0:
+				records[domain] = (socket.inet_ntoa(answers[0].rdata),
+					answers[0].ttl)
+			elif allow_missing:
+				records[domain] = (None, None)
+			else:
+				raise Exception("No A record for {0} on {1}.".
+					format(domain, self.server))
+		return records
+
+	"""
+	Applies all of the updates in one UPDATE message, which the server
+	applies atomically. Unless `upsert` is true, the old address of each
+	record is given as a prerequisite, so that the update fails if the
+	record was changed by someone else, as with Route 53.
+	"""
+	def write_batch(self, updates, upsert=False, timeout=None):
+		(prereqs, changes) = ([], [])
+		for (domain, (old_ip, _), (new_ip, ttl)) in updates:
+			if not upsert and old_ip is None:
+				prereqs.append(encode_record(domain, TYPE_A, CLASS_NONE, 0, b""))
+			elif not upsert:
+				prereqs.append(encode_record(domain, TYPE_A, CLASS_IN, 0,
+					socket.inet_aton(old_ip)))
+			changes.append(encode_record(domain, TYPE_A, CLASS_ANY, 0, b""))
+			changes.append(encode_record(domain, TYPE_A, CLASS_IN, ttl,
+				socket.inet_aton(new_ip)))
+
+		id = secrets.randbits(16)
+		message = encode_header(id, OPCODE_UPDATE << 11,
+			[1, len(prereqs), len(changes), 0]) + encode_name(self.zone) + \
+			struct.pack("!HH", TYPE_SOA, CLASS_IN) + b"".join(prereqs) + \
+			b"".join(changes)
+		msg = self.exchange(message, timeout)
+
+		rcode = msg.flags & 0xf
+		if rcode != 0:
+			raise Exception("Update rejected by {0}: {1}".
+				format(self.server, rcodes.get(rcode, rcode)))
+		return (True, str(id))
+
+	def committed(self, change_id, timeout=None):
+		return True
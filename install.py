@@ -50,6 +50,11 @@ try:
 	os.makedirs("/usr/lib/python_service")
 	shutil.copy("aws_dns.conf", "/etc")
 	shutil.copy("system_v.py", "/usr/lib/python_service")
+	shutil.copy("systemd.py", "/usr/lib/python_service")
+	shutil.copy("address_sources.py", "/usr/lib/python_service")
+	shutil.copy("credentials.py", "/usr/lib/python_service")
+	shutil.copy("timers.py", "/usr/lib/python_service")
+	shutil.copy("dns_update.py", "/usr/lib/python_service")
 	shutil.copy("aws_dns.py", "/etc/init.d/aws_dns")
 	os.chmod("/etc/init.d/aws_dns", 0o744)
 except OSError as e:
@@ -100,10 +100,17 @@ class logger:
 	"""
 	def __init__(self, service):
 		self.service = service
-		out = subprocess.Popen(
-			["tput", "cols"], stdout=subprocess.PIPE
-		).communicate()[0]
-		self.cols = int(out.decode("utf-8"))
+		# `tput` prints nothing when there is no terminal (e.g. when the
+		# service is started by systemd), so fall back to the default
+		# width below.
+		try:
+			out = subprocess.Popen(
+				["tput", "cols"], stdout=subprocess.PIPE,
+				stderr=subprocess.DEVNULL
+			).communicate()[0]
+			self.cols = int(out.decode("utf-8"))
+		except (OSError, ValueError):
+			self.cols = 0
 
 		# Used to store the number of columns to advance before printing
 		# the `[ OK ]` or `[fail]` status.
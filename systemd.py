@@ -0,0 +1,147 @@
+"""
+File Name: systemd.py
+
+# Introduction
+
+This file contains a minimal implementation of the `sd_notify` protocol, so
+that a service can be run in the foreground under systemd with `Type=notify`
+instead of forking. The service manager then takes care of startup and hang
+detection:
+
+  - `READY=1` is sent once the service has finished initializing, so
+    `systemctl start` returns as soon as the configuration has been validated.
+  - `WATCHDOG=1` is sent periodically from the main loop. If the main loop
+    hangs (e.g. on a stuck network call), the pings stop and systemd restarts
+    the service after `WatchdogSec` has elapsed.
+  - `STATUS=...` is a free-form string that is shown by `systemctl status`.
+
+The protocol is a single datagram per message, sent to the `AF_UNIX` socket
+named by the `NOTIFY_SOCKET` environment variable. If the variable is not set,
+all of the functions below do nothing, so the same code can be used when the
+service is not run by systemd. Notifications are best-effort: errors sending
+them are logged, but never raised, since the socket can briefly disappear while
+systemd re-executes itself.
+
+# Testing
+
+The socket address can be passed to `notifier` explicitly, so that a local
+datagram socket can stand in for systemd:
+
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+	server.bind("/tmp/notify.sock")
+	n = notifier("/tmp/notify.sock", watchdog_usec=2000000)
+	n.ready()
+	server.recv(4096) # b"READY=1"
+"""
+
+import os
+import time
+import socket
+import logging
+
+class notifier:
+	"""
+	Summary of parameters:
+
+	  - `address` is the path of the notification socket. Paths starting
+	    with `@` refer to the abstract namespace. By default, the value of
+	    `NOTIFY_SOCKET` is used.
+	  - `watchdog_usec` is the watchdog timeout in microseconds. By
+	    default, the value of `WATCHDOG_USEC` is used, provided that
+	    `WATCHDOG_PID` is either unset or refers to this process.
+	"""
+	def __init__(self, address=None, watchdog_usec=None):
+		if address is None:
+			address = os.environ.get("NOTIFY_SOCKET")
+		if address is not None and address.startswith("@"):
+			address = "\0" + address[1:]
+		self.address = address
+
+		if watchdog_usec is None:
+			watchdog_usec = self.watchdog_from_env()
+		self.watchdog_usec = watchdog_usec
+		self.socket = None
+
+	"""
+	Reads the watchdog timeout that systemd passes to the service.
+	"""
+	@staticmethod
+	def watchdog_from_env():
+		pid = os.environ.get("WATCHDOG_PID")
+		if pid is not None and pid != str(os.getpid()):
+			return 0
+		try:
+			return int(os.environ.get("WATCHDOG_USEC", "0"))
+		except ValueError:
+			return 0
+
+	"""
+	Returns true if notifications are actually being delivered.
+	"""
+	def enabled(self):
+		return self.address is not None
+
+	"""
+	Returns the number of floating-point seconds between watchdog pings, or
+	zero if the watchdog is disabled. systemd recommends pinging at half of
+	the timeout.
+	"""
+	def watchdog_interval(self):
+		if not self.enabled() or self.watchdog_usec <= 0:
+			return 0
+		return self.watchdog_usec / 2e6
+
+	"""
+	Sends a raw notification. Each keyword argument becomes one `KEY=value`
+	line of the message.
+	"""
+	def notify(self, **fields):
+		if not self.enabled():
+			return
+		msg = "\n".join("{0}={1}".format(k, v) for k, v in fields.items())
+		try:
+			if self.socket is None:
+				self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+			self.socket.sendto(msg.encode("utf-8"), self.address)
+		except OSError as e:
+			logger = logging.getLogger("aws_dns")
+			logger.warning("Failed to notify service manager: {0}".format(e))
+
+	def ready(self):
+		self.notify(READY=1)
+
+	def stopping(self):
+		self.notify(STOPPING=1)
+
+	def watchdog(self):
+		self.notify(WATCHDOG=1)
+
+	"""
+	Sets the status shown by `systemctl status`. The protocol is line-based,
+	so line breaks (e.g. in exception messages) are replaced by spaces.
+	"""
+	def status(self, msg):
+		self.notify(STATUS=" ".join(str(msg).split()))
+
+	"""
+	Sleeps for `seconds`, waking up to ping the watchdog if necessary. This
+	should be used in place of `time.sleep` in the main loop of the service.
+	"""
+	def sleep(self, seconds):
+		interval = self.watchdog_interval()
+		if interval == 0:
+			time.sleep(seconds)
+			return
+
+		end = time.monotonic() + seconds
+		while True:
+			self.watchdog()
+			left = end - time.monotonic()
+			if left <= 0:
+				return
+			time.sleep(min(left, interval))
+
+	def close(self):
+		if self.socket is not None:
+			self.socket.close()
+			self.socket = None
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules are installed side by side in /usr/lib/python_service, so they are
+# imported from the root of the repository.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,196 @@
+import time
+import socket
+import struct
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from address_sources import nat_pmp_source, imds_source, source_chain, \
+	parse_address
+
+"""
+A UDP server on the loopback interface that stands in for a NAT-PMP gateway.
+`reply` maps each request to a response, or to `None` to drop it.
+"""
+class gateway:
+	def __init__(self, reply):
+		self.reply    = reply
+		self.requests = []
+		self.sock     = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(("127.0.0.1", 0))
+		self.port     = self.sock.getsockname()[1]
+		threading.Thread(target=self.serve, daemon=True).start()
+
+	def serve(self):
+		while True:
+			try:
+				(data, addr) = self.sock.recvfrom(64)
+			except OSError:
+				return
+			self.requests.append(data)
+			r = self.reply(data)
+			if r is not None:
+				self.sock.sendto(r, addr)
+
+	def close(self):
+		self.sock.close()
+
+def external_address(addr, result=0, version=0):
+	return struct.pack("!BBHI4s", version, 128, result, 1234,
+		socket.inet_aton(addr))
+
+def test_nat_pmp():
+	g = gateway(lambda _: external_address("93.184.216.34"))
+	try:
+		assert nat_pmp_source("127.0.0.1", g.port).get(1) == "93.184.216.34"
+		assert g.requests == [b"\x00\x00"]
+	finally:
+		g.close()
+
+@pytest.mark.parametrize("reply, error", [
+	(external_address("192.168.1.2"), "not public"),
+	(external_address("93.184.216.34", result=3), "result code: 3"),
+	(b"\x02\x80\x00\x01", "only supports PCP"),
+	(b"\x00\x80\x00", "Short"),
+])
+def test_nat_pmp_errors(reply, error):
+	g = gateway(lambda _: reply)
+	try:
+		with pytest.raises(Exception, match=error):
+			nat_pmp_source("127.0.0.1", g.port).get(1)
+	finally:
+		g.close()
+
+def test_nat_pmp_retries():
+	# The first request is lost.
+	g = gateway(lambda _: None if len(g.requests) == 1 else
+		external_address("93.184.216.34"))
+	try:
+		source = nat_pmp_source("127.0.0.1", g.port, timeout=0.05)
+		assert source.get(1) == "93.184.216.34"
+		assert len(g.requests) == 2
+	finally:
+		g.close()
+
+def test_nat_pmp_no_response():
+	g = gateway(lambda _: None)
+	try:
+		source = nat_pmp_source("127.0.0.1", g.port, timeout=0.02, tries=3)
+		with pytest.raises(Exception, match="No NAT-PMP response") as e:
+			source.get(5)
+		assert not isinstance(e.value, TimeoutError)
+		assert len(g.requests) == 3
+		with pytest.raises(TimeoutError):
+			nat_pmp_source("127.0.0.1", g.port, timeout=1).get(0.05)
+	finally:
+		g.close()
+
+"""
+An HTTP server that stands in for the EC2 instance metadata service.
+"""
+class metadata(ThreadingHTTPServer):
+	def __init__(self, address="93.184.216.34"):
+		super().__init__(("127.0.0.1", 0), metadata_handler)
+		self.address  = address
+		self.tokens   = []
+		self.requests = []
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+
+	def endpoint(self):
+		return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+class metadata_handler(BaseHTTPRequestHandler):
+	def reply(self, status, body=b""):
+		self.send_response(status)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_PUT(self):
+		self.server.requests.append(("PUT", self.path))
+		if self.path != "/latest/api/token" or \
+			not "X-aws-ec2-metadata-token-ttl-seconds" in self.headers:
+			return self.reply(400)
+		token = "token-{0}".format(len(self.server.tokens))
+		self.server.tokens.append(token)
+		self.reply(200, token.encode("utf-8"))
+
+	def do_GET(self):
+		self.server.requests.append(("GET", self.path))
+		if self.server.tokens[-1:] != [self.headers.get("X-aws-ec2-metadata-token")]:
+			return self.reply(401)
+		if self.server.address is None:
+			return self.reply(404)
+		self.reply(200, self.server.address.encode("utf-8"))
+
+	def log_message(self, *args):
+		pass
+
+def test_imds_token_is_cached():
+	m = metadata()
+	try:
+		source = imds_source(m.endpoint())
+		assert source.get(1) == "93.184.216.34"
+		assert source.get(1) == "93.184.216.34"
+		assert m.requests.count(("PUT", "/latest/api/token")) == 1
+		assert m.requests.count(("GET", "/latest/meta-data/public-ipv4")) == 2
+	finally:
+		m.stop()
+
+def test_imds_token_renewed_when_rejected():
+	m = metadata()
+	try:
+		source = imds_source(m.endpoint())
+		source.get(1)
+		# The instance was restarted, which invalidates old tokens.
+		m.tokens.append("token-new")
+		assert source.get(1) == "93.184.216.34"
+		assert m.requests.count(("PUT", "/latest/api/token")) == 2
+	finally:
+		m.stop()
+
+def test_imds_no_public_address():
+	m = metadata(None)
+	try:
+		with pytest.raises(Exception, match="no public IPv4"):
+			imds_source(m.endpoint()).get(1)
+	finally:
+		m.stop()
+
+class fake_source:
+	def __init__(self, name, result):
+		(self.name, self.result, self.calls) = (name, result, 0)
+
+	def get(self, timeout=None):
+		self.calls += 1
+		if isinstance(self.result, Exception):
+			raise self.result
+		return self.result
+
+def test_chain_skips_failed_sources():
+	(a, b) = (fake_source("a", Exception("down")), fake_source("b", "1.2.3.4"))
+	chain = source_chain([a, b], backoff=3600)
+	assert chain.get(1) == "1.2.3.4"
+	assert chain.get(1) == "1.2.3.4"
+	assert (a.calls, b.calls) == (1, 2)
+
+	chain.skip["a"] = time.monotonic()
+	a.result = "5.6.7.8"
+	assert chain.get(1) == "5.6.7.8"
+
+def test_chain_last_source_is_never_skipped():
+	a = fake_source("a", TimeoutError("slow"))
+	chain = source_chain([a])
+	for _ in range(2):
+		with pytest.raises(TimeoutError):
+			chain.get(1)
+	assert a.calls == 2
+
+def test_parse_address():
+	assert parse_address(" 93.184.216.34\n") == "93.184.216.34"
+	assert parse_address("10.0.0.1") == "10.0.0.1"
+	with pytest.raises(Exception):
+		parse_address("10.0.0.1", public=True)
@@ -0,0 +1,411 @@
+import sys
+import json
+import time
+import pytest
+import aws_dns
+from aws_dns import get_json, normalize_name, read_desired, diff_records, \
+	chunk_changes, debouncer, ttl_policy, deadline, update_records, start
+
+A = "93.184.216.34"
+B = "198.51.100.1"
+C = "198.51.100.2"
+
+"""
+Stands in for a DNS backend. Writes are applied to `records` right away, but
+are only reported as committed after `commit_after` polls, unless `insync` is
+true.
+"""
+class fake_backend:
+	def __init__(self, records, insync=False, commit_after=0):
+		self.records      = dict(records)
+		self.insync       = insync
+		self.commit_after = commit_after
+		self.reads        = []
+		self.writes       = []
+		self.polls        = 0
+
+	def read_records(self, domains, allow_missing=False, timeout=None):
+		self.reads.append(allow_missing)
+		records = {d: self.records.get(d, (None, None)) for d in domains}
+		if not allow_missing and (None, None) in records.values():
+			raise Exception("Missing record.")
+		return records
+
+	def write_batch(self, updates, upsert=False, timeout=None):
+		self.writes.append((list(updates), upsert))
+		for (domain, _, new) in updates:
+			self.records[domain] = new
+		self.polls = 0
+		return (self.insync, "C{0}".format(len(self.writes)))
+
+	def committed(self, change_id, timeout=None):
+		self.polls += 1
+		return self.polls > self.commit_after
+
+"""
+Returns the addresses in `ips` in turn, calling `hook` first if given, and
+stops `start` once they run out. Exceptions in `ips` are raised.
+"""
+class fake_source:
+	def __init__(self, ips, hook=None):
+		self.ips   = list(ips)
+		self.hook  = hook
+		self.calls = []
+
+	def get(self, timeout=None):
+		self.calls.append(time.monotonic())
+		if len(self.ips) == 0:
+			raise SystemExit
+		if self.hook is not None:
+			self.hook(len(self.calls))
+		ip = self.ips.pop(0)
+		if isinstance(ip, Exception):
+			raise ip
+		return ip
+
+class fake_notifier:
+	def __init__(self):
+		self.statuses = []
+
+	def watchdog_interval(self):
+		return 0
+
+	def status(self, msg):
+		self.statuses.append(msg)
+
+	def watchdog(self):
+		pass
+
+	def sleep(self, seconds):
+		time.sleep(seconds)
+
+def run(backend, source, domains=["a.example.com."], recheck=0.01,
+	observations=None, window=None, min_ttl=None, max_ttl=None, upsert=False,
+	reconcile=3600, cycle_deadline=5):
+	notify = fake_notifier()
+	with pytest.raises(SystemExit):
+		start(domains, backend, recheck, notify, source, observations, window,
+			min_ttl, max_ttl, upsert, reconcile, cycle_deadline, 0)
+	return notify
+
+def test_debouncer_observations():
+	d = debouncer(A, observations=3)
+	assert d.observe(B, 0) == A
+	assert (d.candidate, d.count) == (B, 1)
+	assert not d.expecting(0)
+	assert d.observe(B, 1) == A
+	assert d.expecting(1)
+	assert d.observe(B, 2) == B
+	assert (d.stable_ip, d.candidate) == (B, None)
+
+def test_debouncer_window():
+	d = debouncer(A, window=100)
+	assert d.observe(B, 0) == A
+	assert not d.expecting(49)
+	assert d.observe(B, 50) == A
+	assert d.expecting(50)
+	assert d.observe(B, 100) == B
+
+def test_debouncer_either_criterion():
+	d = debouncer(A, observations=10, window=100)
+	d.observe(B, 0)
+	assert d.observe(B, 100) == B
+	d = debouncer(A, observations=2, window=100)
+	d.observe(B, 0)
+	assert d.observe(B, 1) == B
+
+def test_debouncer_revert_cancels():
+	d = debouncer(A, observations=2)
+	d.observe(B, 0)
+	assert d.observe(A, 1) == A
+	assert d.candidate is None
+	# The count starts over.
+	assert d.observe(B, 2) == A
+	assert d.observe(B, 3) == B
+
+def test_debouncer_switching_candidates():
+	d = debouncer(A, observations=2, window=100)
+	d.observe(B, 0)
+	assert d.observe(C, 60) == A
+	assert (d.candidate, d.count, d.since) == (C, 1, 60)
+	assert d.observe(C, 61) == C
+
+def test_debouncer_disabled():
+	d = debouncer(None)
+	assert d.observe(A, 0) == A
+	assert d.observe(B, 1) == B
+
+def test_updates_are_coalesced():
+	domains = ["a.example.com.", "b.example.com.", "c.example.com."]
+	backend = fake_backend({d: (A, 300) for d in domains}, insync=True)
+	run(backend, fake_source([A, B, B]), domains)
+	assert len(backend.writes) == 1
+	(updates, _) = backend.writes[0]
+	assert updates == [(d, (A, 300), (B, 300)) for d in domains]
+
+def test_flap_is_not_published():
+	backend = fake_backend({"a.example.com.": (A, 300)})
+	run(backend, fake_source([A, B, A, B, A]), observations=2)
+	assert backend.writes == []
+
+def test_updates_held_back_while_pending():
+	backend = fake_backend({"a.example.com.": (A, 300)}, commit_after=3)
+	run(backend, fake_source([B] + [C] * 10))
+	assert [w[0] for w in backend.writes] == [
+		[("a.example.com.", (A, 300), (B, 300))],
+		[("a.example.com.", (B, 300), (C, 300))]]
+
+def test_ttl_seeded_from_live_ttl():
+	# A record that was just read is treated as having been stable for long
+	# enough to justify its TTL, so it is not rewritten at startup.
+	p = ttl_policy(60, 3600, 300, 1000)
+	assert p.target(1000, False) == 300
+	assert not p.should_update(300, p.target(1000, False))
+	assert p.target(1400, False) == 400
+
+def test_ttl_bounds():
+	p = ttl_policy(60, 3600, 300, 0)
+	assert p.target(0, True) == 60
+	assert p.target(10 ** 6, False) == 3600
+	assert ttl_policy(60, 3600, 10, 0).target(0, False) == 60
+
+def test_ttl_changed_by_factors_of_two():
+	p = ttl_policy(60, 3600, 300, 0)
+	assert not p.should_update(300, 599)
+	assert p.should_update(300, 600)
+	assert not p.should_update(300, 151)
+	assert p.should_update(300, 150)
+	# Moves to a bound are always made.
+	assert p.should_update(2000, 3600)
+	assert p.should_update(100, 60)
+	assert not p.should_update(3600, 3600)
+
+def test_ttl_capped_by_median_interval():
+	p = ttl_policy(60, 3600, 300, 0)
+	for t in [1000, 2000, 3000]:
+		p.changed(t)
+	assert list(p.intervals) == [2200, 1000, 1000]
+	assert p.target(10 ** 6, False) == 250
+
+def test_ttl_debounced_change_counted_once():
+	p = ttl_policy(60, 3600, 300, 0)
+	p.flapped(1000)
+	p.changed(1100)
+	assert list(p.intervals) == [2200]
+	assert p.last_change == 1100
+	p.changed(2000)
+	assert list(p.intervals) == [2200, 1000]
+
+def test_ttl_kept_by_default():
+	backend = fake_backend({"a.example.com.": (A, 120)}, insync=True)
+	run(backend, fake_source([B]))
+	assert backend.writes[0][0] == [("a.example.com.", (A, 120), (B, 120))]
+
+def test_ttl_lowered_on_change():
+	backend = fake_backend({"a.example.com.": (A, 300)}, insync=True)
+	run(backend, fake_source([B]), min_ttl=60, max_ttl=3600)
+	assert backend.writes[0][0] == [("a.example.com.", (A, 300), (B, 60))]
+
+@pytest.mark.parametrize("upsert, actions", [
+	(True, [("UPSERT", B)]),
+	(False, [("DELETE", A), ("CREATE", B)]),
+])
+def test_update_records_actions(monkeypatch, upsert, actions):
+	batches = []
+	monkeypatch.setattr(aws_dns, "submit_changes",
+		lambda zone_id, changes, timeout: batches.append(changes))
+	update_records("Z1", [("a.example.com.", (A, 300), (B, 300))], upsert)
+	assert [(c["Action"], c["ResourceRecordSet"]["ResourceRecords"][0]["Value"])
+		for c in batches[0]] == actions
+
+def test_upsert_creates_missing_records():
+	backend = fake_backend({}, insync=True)
+	run(backend, fake_source([B, B]), upsert=True)
+	# The records are only read once at startup, not before each write.
+	assert backend.reads == [True]
+	assert backend.writes == [
+		([("a.example.com.", (None, None), (B, 300))], True)]
+
+def test_reconcile_picks_up_outside_edits():
+	backend = fake_backend({"a.example.com.": (A, 300)}, insync=True)
+	def edit(call):
+		if call == 2:
+			backend.records["a.example.com."] = (C, 300)
+	run(backend, fake_source([A] * 20, edit), reconcile=0.03)
+	assert len(backend.reads) >= 2
+	assert [w[0] for w in backend.writes] == [
+		[("a.example.com.", (C, 300), (A, 300))]]
+
+def test_reconcile_recreates_deleted_records():
+	backend = fake_backend({"a.example.com.": (A, 300)}, insync=True)
+	def delete(call):
+		if call == 2:
+			del backend.records["a.example.com."]
+	run(backend, fake_source([A] * 20, delete), upsert=True, reconcile=0.03)
+	assert backend.writes == [
+		([("a.example.com.", (None, None), (A, 300))], True)]
+
+def test_get_json():
+	assert get_json([sys.executable, "-c", "print('{\"a\": 1}')"]) == {"a": 1}
+	with pytest.raises(Exception, match="oops") as e:
+		get_json([sys.executable, "-c",
+			"import sys; sys.stderr.write('oops'); sys.exit(1)"])
+	assert not isinstance(e.value, TimeoutError)
+
+def test_get_json_kills_stuck_command():
+	begin = time.monotonic()
+	with pytest.raises(TimeoutError, match="killed"):
+		get_json([sys.executable, "-c", "import time; time.sleep(30)"], 0.2)
+	assert time.monotonic() - begin < 5
+
+def test_deadline_budgets(monkeypatch):
+	clock = [100]
+	monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+	limit = deadline(10)
+	assert limit.budget("commit") == 2
+	assert limit.budget("reconcile") == 3
+	clock[0] = 108
+	assert limit.budget("update") == 2
+	clock[0] = 110
+	with pytest.raises(TimeoutError, match="before address stage"):
+		limit.budget("address")
+
+def test_timeouts_retried_once_right_away():
+	backend = fake_backend({"a.example.com.": (A, 300)})
+	source = fake_source([TimeoutError("slow"), TimeoutError("slow"),
+		Exception("down")])
+	notify = run(backend, source, recheck=0.2)
+	gaps = [b - a for (a, b) in zip(source.calls, source.calls[1:])]
+	assert gaps[0] < 0.1
+	assert gaps[1] > 0.15 and gaps[2] > 0.15
+	assert "1 errors, 2 timeouts" in notify.statuses[-1]
+
+def test_timed_out_update_is_reread():
+	# The change was submitted before the command was killed.
+	class slow_backend(fake_backend):
+		def write_batch(self, updates, upsert=False, timeout=None):
+			super().write_batch(updates, upsert, timeout)
+			raise TimeoutError("slow")
+	backend = slow_backend({"a.example.com.": (A, 300)})
+	run(backend, fake_source([B, B]))
+	assert len(backend.reads) == 2
+	assert len(backend.writes) == 1
+
+def test_normalize_name():
+	assert normalize_name("Bob.Example.com") == "bob.example.com."
+	assert normalize_name("bob.example.com.") == "bob.example.com."
+	assert normalize_name("\\052.example.com.") == "*.example.com."
+
+def write_spec(tmp_path, spec):
+	path = tmp_path / "records.json"
+	path.write_text(json.dumps(spec))
+	return str(path)
+
+def test_read_desired(tmp_path):
+	path = write_spec(tmp_path, {"hosted-zone-id": "Z1", "records": [
+		{"name": "Bob.example.com", "type": "a", "ttl": 300,
+			"values": ["198.51.100.2", "198.51.100.1"]},
+		{"name": "*.example.com.", "type": "TXT", "ttl": 60, "values": ["\"x\""]}]})
+	assert read_desired(path) == ("Z1", {
+		("bob.example.com.", "A"): (300, ["198.51.100.1", "198.51.100.2"]),
+		("*.example.com.", "TXT"): (60, ["\"x\""])}, False)
+	path = write_spec(tmp_path, {"hosted-zone-id": "Z1", "records": [],
+		"prune": "yes"})
+	assert read_desired(path)[2] is False
+
+@pytest.mark.parametrize("spec, error", [
+	({"records": []}, "hosted-zone-id"),
+	({"hosted-zone-id": "Z1", "records": [{"name": "a", "type": "A",
+		"ttl": 300}]}, "Record 0 must have"),
+	({"hosted-zone-id": "Z1", "records": [{"name": "a", "type": "A",
+		"ttl": "300", "values": ["1.2.3.4"]}]}, "integer TTL"),
+	({"hosted-zone-id": "Z1", "records": [{"name": "a", "type": "A",
+		"ttl": 300, "values": []}]}, "nonempty"),
+	({"hosted-zone-id": "Z1", "records": [
+		{"name": "a.example.com", "type": "A", "ttl": 300, "values": ["1.2.3.4"]},
+		{"name": "A.example.com.", "type": "a", "ttl": 60, "values": ["1.2.3.4"]}]},
+		"Record 1 duplicates"),
+])
+def test_read_desired_errors(tmp_path, spec, error):
+	with pytest.raises(Exception, match=error):
+		read_desired(write_spec(tmp_path, spec))
+
+def record_set(name, type, values, ttl=300, **extra):
+	return dict({"Name": name, "Type": type, "TTL": ttl,
+		"ResourceRecords": [{"Value": v} for v in values]}, **extra)
+
+zone = [
+	record_set("example.com.", "SOA", ["ns.example.net. admin 1 2 3 4 5"]),
+	record_set("example.com.", "NS", ["ns.example.net."]),
+	record_set("sub.example.com.", "NS", ["ns.example.org."]),
+	record_set("a.example.com.", "A", [A]),
+	record_set("b.example.com.", "A", [A], ttl=60),
+	record_set("c.example.com.", "CNAME", ["a.example.com."]),
+	record_set("\\052.example.com.", "TXT", ["\"x\""]),
+	{"Name": "www.example.com.", "Type": "A",
+		"AliasTarget": {"DNSName": "lb.example.net."}},
+	record_set("geo.example.com.", "A", [B], SetIdentifier="eu"),
+]
+
+desired = {
+	("a.example.com.", "A"): (300, [A]),
+	("b.example.com.", "A"): (300, [A]),
+	("c.example.com.", "A"): (300, [B]),
+	("*.example.com.", "TXT"): (300, ["\"x\""]),
+}
+
+def test_diff_records():
+	(changes, unchanged) = diff_records(desired, zone, False)
+	assert unchanged == 2
+	assert [(c["Action"], c["ResourceRecordSet"]["Name"],
+		c["ResourceRecordSet"]["Type"]) for c in changes] == [
+		("UPSERT", "b.example.com.", "A"),
+		("CREATE", "c.example.com.", "A")]
+
+def test_diff_records_prune():
+	# The apex NS and SOA records, aliases, and routing-policy record sets
+	# are kept; deletions come before the other changes to the same name.
+	(changes, _) = diff_records(desired, zone, True)
+	assert [(c["Action"], c["ResourceRecordSet"]["Name"],
+		c["ResourceRecordSet"]["Type"]) for c in changes] == [
+		("UPSERT", "b.example.com.", "A"),
+		("DELETE", "c.example.com.", "CNAME"),
+		("CREATE", "c.example.com.", "A"),
+		("DELETE", "sub.example.com.", "NS")]
+	assert changes[1]["ResourceRecordSet"] == zone[5]
+
+def change(action, name, values):
+	return {"Action": action, "ResourceRecordSet": record_set(name, "A", values)}
+
+def names(chunks):
+	return [[c["ResourceRecordSet"]["Name"] for c in chunk] for chunk in chunks]
+
+def test_chunk_record_limit():
+	changes = [change("CREATE", "{0}.example.com.".format(i), [A] * 100)
+		for i in range(10)]
+	assert len(chunk_changes(changes)) == 1
+	changes.append(change("CREATE", "x.example.com.", [A]))
+	assert [len(c) for c in chunk_changes(changes)] == [10, 1]
+
+def test_chunk_character_limit():
+	changes = [change("CREATE", "{0}.example.com.".format(i), ["x" * 8000])
+		for i in range(4)]
+	assert len(chunk_changes(changes)) == 1
+	changes.append(change("CREATE", "x.example.com.", ["x"]))
+	assert [len(c) for c in chunk_changes(changes)] == [4, 1]
+
+def test_chunk_upserts_count_twice():
+	changes = [change("UPSERT", "{0}.example.com.".format(i), [A])
+		for i in range(500)]
+	assert len(chunk_changes(changes)) == 1
+	changes.append(change("UPSERT", "x.example.com.", [A]))
+	assert [len(c) for c in chunk_changes(changes)] == [500, 1]
+
+def test_chunk_keeps_names_together():
+	changes = [change("CREATE", "a.example.com.", [A] * 3),
+		change("DELETE", "b.example.com.", [A]),
+		change("CREATE", "b.example.com.", [B]),
+		change("CREATE", "c.example.com.", [A] * 6)]
+	assert names(chunk_changes(changes, max_records=4)) == [
+		["a.example.com."], ["b.example.com.", "b.example.com."],
+		["c.example.com."]]
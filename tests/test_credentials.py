@@ -0,0 +1,219 @@
+import time
+import threading
+import urllib.parse
+import pytest
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from credentials import Credentials, credential_provider, sign_request, \
+	unsupported
+
+def test_sign_request_vanilla():
+	# The `get-vanilla` case of the AWS Signature Version 4 test suite.
+	creds = Credentials("AKIDEXAMPLE",
+		"wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY", None, None)
+	headers = sign_request("GET", "https://example.amazonaws.com/", b"", {},
+		creds, "us-east-1", "service",
+		datetime(2015, 8, 30, 12, 36, tzinfo=timezone.utc))
+	assert headers["X-Amz-Date"] == "20150830T123600Z"
+	assert headers["Authorization"] == "AWS4-HMAC-SHA256 " \
+		"Credential=AKIDEXAMPLE/20150830/us-east-1/service/aws4_request, " \
+		"SignedHeaders=host;x-amz-date, Signature=" \
+		"5fa00fa31553b73ebf1942676e86291e8372ff2a2260956d9b8aae1d763fbf31"
+
+def test_sign_request_session_token():
+	creds = Credentials("AKID", "secret", "session", None)
+	headers = sign_request("POST", "https://sts.amazonaws.com/", b"x", {},
+		creds, "us-east-1", "sts")
+	assert headers["X-Amz-Security-Token"] == "session"
+	assert "x-amz-security-token" in headers["Authorization"]
+
+response = """<AssumeRoleResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <AssumeRoleResult>
+    <Credentials>
+      <AccessKeyId>ASIA{0}</AccessKeyId>
+      <SecretAccessKey>role-secret-{0}</SecretAccessKey>
+      <SessionToken>role-token-{0}</SessionToken>
+      <Expiration>{1}</Expiration>
+    </Credentials>
+  </AssumeRoleResult>
+</AssumeRoleResponse>"""
+
+error = """<ErrorResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <Error><Code>AccessDenied</Code><Message>Not authorized</Message></Error>
+</ErrorResponse>"""
+
+"""
+An HTTP server that stands in for STS. It checks the signature of each
+`AssumeRole` request against the secret keys in `secrets`, and answers with
+credentials that expire after the requested `DurationSeconds`.
+"""
+class sts(ThreadingHTTPServer):
+	def __init__(self, secrets):
+		super().__init__(("127.0.0.1", 0), sts_handler)
+		self.secrets  = secrets
+		self.requests = []
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+
+	def endpoint(self):
+		return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+class sts_handler(BaseHTTPRequestHandler):
+	def reply(self, status, body):
+		body = body.encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers["Content-Length"]))
+		params = dict(urllib.parse.parse_qsl(body.decode("utf-8")))
+		self.server.requests.append(params)
+
+		# Recompute the signature from the signed headers.
+		auth = self.headers["Authorization"]
+		access_key = auth.split("Credential=")[1].split("/")[0]
+		signed = auth.split("SignedHeaders=")[1].split(",")[0].split(";")
+		if not access_key in self.server.secrets:
+			return self.reply(403, error)
+		creds = Credentials(access_key, self.server.secrets[access_key],
+			self.headers.get("X-Amz-Security-Token"), None)
+		headers = {k: self.headers[k] for k in signed if k not in
+			["host", "x-amz-date", "x-amz-security-token"]}
+		date = datetime.strptime(self.headers["X-Amz-Date"],
+			"%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+		expected = sign_request("POST", self.server.endpoint() + "/", body,
+			headers, creds, "us-east-1", "sts", date)["Authorization"]
+		if auth != expected:
+			return self.reply(403, error)
+
+		n = len(self.server.requests)
+		expiry = datetime.fromtimestamp(time.time() +
+			int(params["DurationSeconds"]), timezone.utc)
+		self.server.secrets["ASIA{0}".format(n)] = "role-secret-{0}".format(n)
+		self.reply(200, response.format(n, expiry.strftime("%Y-%m-%dT%H:%M:%SZ")))
+
+	def log_message(self, *args):
+		pass
+
+@pytest.fixture
+def env(monkeypatch):
+	for key in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN",
+		"AWS_PROFILE"]:
+		monkeypatch.delenv(key, raising=False)
+	return monkeypatch
+
+def write_profiles(tmp_path, config, creds):
+	(tmp_path / "config").write_text(config)
+	(tmp_path / "credentials").write_text(creds)
+	return {"config_file": str(tmp_path / "config"),
+		"credentials_file": str(tmp_path / "credentials")}
+
+def test_static_profile(tmp_path, env):
+	files = write_profiles(tmp_path, "",
+		"[dns]\naws_access_key_id = AKID\naws_secret_access_key = secret\n")
+	p = credential_provider("dns", **files)
+	p.start()
+	assert p.get() == Credentials("AKID", "secret", None, None)
+	assert p.thread is None
+
+	env.setenv("AWS_PROFILE", "other")
+	e = p.env()
+	assert (e["AWS_ACCESS_KEY_ID"], e["AWS_SECRET_ACCESS_KEY"]) == ("AKID", "secret")
+	assert not "AWS_PROFILE" in e and not "AWS_SESSION_TOKEN" in e
+
+def test_environment_takes_precedence(tmp_path, env):
+	files = write_profiles(tmp_path, "",
+		"[default]\naws_access_key_id = AKID\naws_secret_access_key = secret\n")
+	env.setenv("AWS_ACCESS_KEY_ID", "ENVKEY")
+	env.setenv("AWS_SECRET_ACCESS_KEY", "envsecret")
+	p = credential_provider(**files)
+	p.start()
+	assert p.get().access_key == "ENVKEY"
+
+def test_assume_role_chain(tmp_path, env):
+	server = sts({"AKID": "secret"})
+	try:
+		files = write_profiles(tmp_path,
+			"[profile base]\nrole_arn = arn:aws:iam::1:role/base\n"
+			"source_profile = keys\n"
+			"[profile dns]\nrole_arn = arn:aws:iam::1:role/dns\n"
+			"source_profile = base\nexternal_id = xyz\nduration_seconds = 900\n",
+			"[keys]\naws_access_key_id = AKID\naws_secret_access_key = secret\n")
+		p = credential_provider("dns", server.endpoint(), **files)
+		p.start()
+		p.stop()
+
+		# The second call is signed with the credentials from the first.
+		assert [r["RoleArn"] for r in server.requests] == \
+			["arn:aws:iam::1:role/base", "arn:aws:iam::1:role/dns"]
+		assert server.requests[1]["ExternalId"] == "xyz"
+		assert server.requests[1]["DurationSeconds"] == "900"
+		creds = p.get()
+		assert (creds.access_key, creds.token) == ("ASIA2", "role-token-2")
+		assert 800 < creds.expiry - time.time() <= 900
+		assert p.env()["AWS_SESSION_TOKEN"] == "role-token-2"
+	finally:
+		server.stop()
+
+def test_assume_role_denied(tmp_path, env):
+	server = sts({})
+	try:
+		files = write_profiles(tmp_path,
+			"[profile dns]\nrole_arn = arn:aws:iam::1:role/dns\n"
+			"source_profile = keys\n",
+			"[keys]\naws_access_key_id = AKID\naws_secret_access_key = secret\n")
+		with pytest.raises(Exception, match="Not authorized"):
+			credential_provider("dns", server.endpoint(), **files).start()
+	finally:
+		server.stop()
+
+@pytest.mark.parametrize("config", [
+	"[profile dns]\nsso_start_url = https://example.com\n",
+	"[profile dns]\nrole_arn = arn:aws:iam::1:role/dns\nmfa_serial = x\n"
+		"source_profile = dns\n",
+	"[profile dns]\nrole_arn = arn:aws:iam::1:role/dns\n"
+		"credential_source = Ec2InstanceMetadata\n",
+	"",
+])
+def test_unsupported_profiles(tmp_path, env, config):
+	files = write_profiles(tmp_path, config, "")
+	with pytest.raises(unsupported):
+		credential_provider("dns", **files).start()
+
+def test_refresh_short_lived_credentials(env):
+	# Credentials at the STS minimum lifetime must not be refreshed
+	# back-to-back.
+	p = credential_provider()
+	calls = []
+	def resolve():
+		calls.append(time.time())
+		return Credentials("AKID", "secret", "token", time.time() + 900)
+	p.resolve = resolve
+	p.start()
+	time.sleep(0.5)
+	p.stop()
+	assert len(calls) == 1
+
+def test_refresh_backs_off(env):
+	p = credential_provider()
+	p.creds = Credentials("AKID", "secret", "token", time.time() - 5)
+	p.obtained = time.time() - 905
+	calls = []
+	def resolve():
+		calls.append(time.monotonic())
+		raise Exception("STS is down")
+	p.resolve = resolve
+	t = threading.Thread(target=p.refresh_loop, args=(0.05, 0.2))
+	t.start()
+	time.sleep(1)
+	p.stop()
+	t.join()
+	gaps = [b - a for (a, b) in zip(calls, calls[1:])]
+	assert 4 <= len(calls) <= 9
+	assert gaps[0] < gaps[1] < gaps[2]
+	assert p.get().access_key == "AKID"
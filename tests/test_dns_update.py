@@ -0,0 +1,260 @@
+import time
+import socket
+import struct
+import base64
+import threading
+import pytest
+from dns_update import tsig_key, rfc2136_backend, parse_message, read_name, \
+	encode_header, encode_name, encode_record, TYPE_A, TYPE_SOA, TYPE_TSIG, \
+	CLASS_IN, CLASS_NONE, CLASS_ANY, OPCODE_UPDATE
+
+secret = base64.b64encode(b"k" * 32).decode("ascii")
+
+def test_sign_matches_reference():
+	# Produced by dnspython for the same query, key, and time.
+	query = encode_header(0x1234, 0, [1, 0, 0, 0]) + \
+		encode_name("a.example.com") + struct.pack("!HH", TYPE_A, CLASS_IN)
+	(signed, mac) = tsig_key("upd-key", secret).sign(query,
+		time_signed=1700000000)
+	assert mac.hex() == "3cece00d35cf80c0796382c4d535b83a" \
+		"598f0a3c96020324eb29e234ea025aac"
+	assert signed == query[:10] + b"\x00\x01" + query[12:] + \
+		encode_name("upd-key") + struct.pack("!HHIH", TYPE_TSIG, CLASS_ANY,
+		0, 61) + encode_name("hmac-sha256") + \
+		bytes.fromhex("00006553f100012c0020") + mac + b"\x12\x34\0\0\0\0"
+
+def test_verify_reference_response(monkeypatch):
+	# A compressed, signed response produced by dnspython.
+	response = bytes.fromhex(
+		"1234800000010001000000010161076578616d706c6503636f6d0000010001c00c"
+		"000100010000012c00045db8d822077570642d6b65790000fa00ff00000000003d"
+		"0b686d61632d7368613235360000006553f100012c0020dfe1150c6712ce3d9d62"
+		"df7fc9656b6c0ff1778e56d54f2c8f646efc7abd4d04123400000000")
+	mac = bytes.fromhex("3cece00d35cf80c0796382c4d535b83a"
+		"598f0a3c96020324eb29e234ea025aac")
+	key = tsig_key("upd-key", secret)
+	msg = parse_message(response)
+	assert msg.answers[0].name == "a.example.com."
+	assert socket.inet_ntoa(msg.answers[0].rdata) == "93.184.216.34"
+
+	monkeypatch.setattr(time, "time", lambda: 1700000100)
+	key.verify(response, msg, mac)
+	with pytest.raises(Exception, match="Bad TSIG signature"):
+		key.verify(response, msg, b"\0" * 32)
+	monkeypatch.setattr(time, "time", lambda: 1700001000)
+	with pytest.raises(Exception, match="fudge"):
+		key.verify(response, msg, mac)
+
+def test_unsupported_algorithm():
+	with pytest.raises(Exception, match="Unsupported"):
+		tsig_key("upd-key", secret, "hmac-whirlpool")
+	assert tsig_key("upd-key", secret, "hmac-md5").algorithm == \
+		"hmac-md5.sig-alg.reg.int."
+
+"""
+A DNS server on the loopback interface that stands in for the authoritative
+server. It serves the A records in `zone`, applies UPDATE messages with
+prerequisites, and checks and signs messages with `key`. The following flags
+change its behavior:
+
+  - `truncate` answers every UDP request with an empty truncated response.
+  - `drop` ignores UDP requests.
+  - `refuse` answers with an unsigned REFUSED.
+"""
+class stub_server:
+	def __init__(self, zone, key):
+		self.zone     = dict(zone)
+		self.key      = key
+		self.truncate = False
+		self.drop     = False
+		self.refuse   = False
+		self.udp      = 0
+		self.tcp      = 0
+		self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.udp_sock.bind(("127.0.0.1", 0))
+		self.port     = self.udp_sock.getsockname()[1]
+		self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.tcp_sock.bind(("127.0.0.1", self.port))
+		self.tcp_sock.listen()
+		threading.Thread(target=self.serve_udp, daemon=True).start()
+		threading.Thread(target=self.serve_tcp, daemon=True).start()
+
+	def serve_udp(self):
+		while True:
+			try:
+				(data, addr) = self.udp_sock.recvfrom(65535)
+			except OSError:
+				return
+			self.udp += 1
+			if self.drop:
+				continue
+			if self.truncate:
+				self.udp_sock.sendto(data[:2] + b"\x82\0" + b"\0" * 8, addr)
+				continue
+			self.udp_sock.sendto(self.handle(data), addr)
+
+	def serve_tcp(self):
+		while True:
+			try:
+				(conn, _) = self.tcp_sock.accept()
+			except OSError:
+				return
+			self.tcp += 1
+			with conn:
+				n = struct.unpack("!H", conn.recv(2))[0]
+				data = b""
+				while len(data) < n:
+					data += conn.recv(n - len(data))
+				r = self.handle(data)
+				conn.sendall(struct.pack("!H", len(r)) + r)
+
+	def handle(self, data):
+		msg = parse_message(data)
+		opcode = (msg.flags >> 11) & 0xf
+		question = encode_name(msg.questions[0][0]) + \
+			struct.pack("!HH", *msg.questions[0][1:])
+		if self.refuse:
+			return encode_header(msg.id, 0x8005 | opcode << 11,
+				[1, 0, 0, 0]) + question
+
+		request_mac = b""
+		if self.key is not None:
+			try:
+				self.key.verify(data, msg)
+			except Exception:
+				return self.bad_signature(msg, opcode, question)
+			tsig = msg.additional[-1]
+			(_, offset) = read_name(data, tsig.rdata_start)
+			size = struct.unpack("!H", data[offset + 8:offset + 10])[0]
+			request_mac = data[offset + 10:offset + 10 + size]
+		(rcode, answers) = self.query(msg) if opcode == 0 else \
+			self.update(msg)
+
+		response = encode_header(msg.id, 0x8000 | opcode << 11 | rcode,
+			[1, len(answers), 0, 0]) + question + b"".join(answers)
+		if self.key is not None:
+			(response, _) = self.key.sign(response, request_mac)
+		return response
+
+	"""
+	Answers a request that fails authentication with NOTAUTH and an unsigned
+	TSIG record that reports BADSIG, as required by RFC 8945.
+	"""
+	def bad_signature(self, msg, opcode, question):
+		t = int(time.time())
+		rdata = encode_name(self.key.algorithm) + struct.pack("!HIHHHHH",
+			t >> 32, t & 0xffffffff, 300, 0, msg.id, 16, 0)
+		return encode_header(msg.id, 0x8009 | opcode << 11, [1, 0, 0, 1]) + \
+			question + encode_record(self.key.name, TYPE_TSIG, CLASS_ANY, 0,
+			rdata)
+
+	def query(self, msg):
+		name = msg.questions[0][0]
+		if not name in self.zone:
+			return (3, [])
+		(ip, ttl) = self.zone[name]
+		return (0, [encode_record(name, TYPE_A, CLASS_IN, ttl,
+			socket.inet_aton(ip))])
+
+	def update(self, msg):
+		assert msg.questions[0][1:] == (TYPE_SOA, CLASS_IN)
+		for p in msg.answers:
+			if p.cls == CLASS_NONE and p.name in self.zone:
+				return (7, [])
+			if p.cls == CLASS_IN and self.zone.get(p.name, (None,))[0] != \
+				socket.inet_ntoa(p.rdata):
+				return (8, [])
+		for u in msg.authority:
+			if u.cls == CLASS_ANY:
+				self.zone.pop(u.name, None)
+			else:
+				self.zone[u.name] = (socket.inet_ntoa(u.rdata), u.ttl)
+		return (0, [])
+
+	def close(self):
+		self.udp_sock.close()
+		self.tcp_sock.close()
+
+@pytest.fixture
+def server():
+	s = stub_server({"a.example.com.": ("93.184.216.34", 300)},
+		tsig_key("upd-key", secret))
+	yield s
+	s.close()
+
+def backend(server, **kwargs):
+	return rfc2136_backend("127.0.0.1", "example.com",
+		kwargs.pop("key", tsig_key("upd-key", secret)), server.port, **kwargs)
+
+def test_read_records(server):
+	b = backend(server)
+	assert b.read_records(["a.example.com.", "b.example.com."],
+		allow_missing=True) == {"a.example.com.": ("93.184.216.34", 300),
+		"b.example.com.": (None, None)}
+	with pytest.raises(Exception, match="No A record for b.example.com."):
+		b.read_records(["b.example.com."])
+	assert (server.udp, server.tcp) == (3, 0)
+
+def test_write_batch(server):
+	b = backend(server)
+	(insync, _) = b.write_batch([
+		("a.example.com.", ("93.184.216.34", 300), ("198.51.100.1", 60)),
+		("b.example.com.", (None, None), ("198.51.100.1", 60))])
+	assert insync and b.committed("", 1)
+	assert server.zone == {"a.example.com.": ("198.51.100.1", 60),
+		"b.example.com.": ("198.51.100.1", 60)}
+
+def test_write_batch_prerequisites(server):
+	b = backend(server)
+	stale = [("a.example.com.", ("192.0.2.1", 300), ("198.51.100.1", 60))]
+	with pytest.raises(Exception, match="NXRRSET"):
+		b.write_batch(stale)
+	with pytest.raises(Exception, match="YXRRSET"):
+		b.write_batch([("a.example.com.", (None, None), ("198.51.100.1", 60))])
+	assert server.zone["a.example.com."] == ("93.184.216.34", 300)
+
+	# Without prerequisites, the record is written regardless.
+	b.write_batch(stale, upsert=True)
+	assert server.zone["a.example.com."] == ("198.51.100.1", 60)
+
+def test_truncated_response_retried_over_tcp(server):
+	server.truncate = True
+	assert backend(server).read_records(["a.example.com."]) == \
+		{"a.example.com.": ("93.184.216.34", 300)}
+	assert (server.udp, server.tcp) == (1, 1)
+
+def test_tcp_only(server):
+	backend(server, protocol="tcp").write_batch(
+		[("a.example.com.", ("93.184.216.34", 300), ("198.51.100.1", 60))])
+	assert (server.udp, server.tcp) == (0, 1)
+	assert server.zone["a.example.com."] == ("198.51.100.1", 60)
+
+def test_timeout(server):
+	server.drop = True
+	start = time.monotonic()
+	with pytest.raises(TimeoutError):
+		backend(server).read_records(["a.example.com."], timeout=0.2)
+	assert time.monotonic() - start < 1
+
+def test_wrong_key(server):
+	b = backend(server, key=tsig_key("upd-key",
+		base64.b64encode(b"x" * 32).decode("ascii")))
+	with pytest.raises(Exception, match="BADSIG"):
+		b.write_batch([("a.example.com.", ("93.184.216.34", 300),
+			("198.51.100.1", 60))])
+	assert server.zone["a.example.com."] == ("93.184.216.34", 300)
+
+def test_unsigned_error_response(server):
+	server.refuse = True
+	with pytest.raises(Exception, match="REFUSED"):
+		backend(server).write_batch([("a.example.com.",
+			("93.184.216.34", 300), ("198.51.100.1", 60))])
+
+def test_unsigned_success_rejected(server):
+	# A successful response must be signed if the request was.
+	server.key = None
+	with pytest.raises(Exception, match="not signed"):
+		backend(server).read_records(["a.example.com."])
+	assert backend(server, key=None).read_records(["a.example.com."]) == \
+		{"a.example.com.": ("93.184.216.34", 300)}
@@ -0,0 +1,72 @@
+import os
+import socket
+import pytest
+from systemd import notifier
+
+@pytest.fixture
+def server(tmp_path):
+	path = str(tmp_path / "notify.sock")
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+	sock.bind(path)
+	sock.settimeout(1)
+	yield (sock, path)
+	sock.close()
+
+def test_messages(server):
+	(sock, path) = server
+	n = notifier(path, watchdog_usec=2000000)
+	n.ready()
+	assert sock.recv(4096) == b"READY=1"
+	n.watchdog()
+	assert sock.recv(4096) == b"WATCHDOG=1"
+	n.notify(STATUS="x", ERRNO=5)
+	assert sock.recv(4096) == b"STATUS=x\nERRNO=5"
+	n.stopping()
+	assert sock.recv(4096) == b"STOPPING=1"
+	n.close()
+
+def test_status_is_one_line(server):
+	(sock, path) = server
+	notifier(path).status("Failed:\n  Traceback\tline 1\n")
+	assert sock.recv(4096) == b"STATUS=Failed: Traceback line 1"
+
+def test_abstract_namespace():
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+	name = "aws_dns-test-{0}".format(os.getpid())
+	sock.bind("\0" + name)
+	sock.settimeout(1)
+	notifier("@" + name).ready()
+	assert sock.recv(4096) == b"READY=1"
+	sock.close()
+
+def test_send_errors_are_not_raised(tmp_path):
+	n = notifier(str(tmp_path / "missing.sock"))
+	n.ready()
+	n.watchdog()
+	n.status("still running")
+
+def test_disabled_without_socket(monkeypatch):
+	monkeypatch.delenv("NOTIFY_SOCKET", raising=False)
+	n = notifier(watchdog_usec=2000000)
+	assert not n.enabled()
+	assert n.watchdog_interval() == 0
+	n.ready()
+
+def test_watchdog_from_env(monkeypatch):
+	monkeypatch.setenv("WATCHDOG_USEC", "60000000")
+	monkeypatch.setenv("WATCHDOG_PID", str(os.getpid()))
+	assert notifier("/nonexistent").watchdog_interval() == 30
+	monkeypatch.setenv("WATCHDOG_PID", str(os.getpid() + 1))
+	assert notifier("/nonexistent").watchdog_interval() == 0
+
+def test_sleep_pings_watchdog(server):
+	(sock, path) = server
+	notifier(path, watchdog_usec=100000).sleep(0.12)
+	sock.settimeout(0)
+	pings = []
+	while True:
+		try:
+			pings.append(sock.recv(4096))
+		except BlockingIOError:
+			break
+	assert len(pings) >= 3 and set(pings) == {b"WATCHDOG=1"}
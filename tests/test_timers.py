@@ -0,0 +1,73 @@
+import time
+import pytest
+import timers
+from timers import timer_wheel, now
+
+@pytest.fixture(params=["timerfd", "sleep"])
+def wheel(request, monkeypatch):
+	if request.param == "sleep":
+		def unavailable():
+			raise OSError("timerfd is not available.")
+		monkeypatch.setattr(timers, "timerfd", unavailable)
+	w = timer_wheel()
+	if request.param == "timerfd" and w.fd is None:
+		pytest.skip("timerfd is not supported here")
+	yield w
+	w.close()
+
+def test_fallback_without_timerfd(monkeypatch):
+	def unavailable():
+		raise OSError("timerfd is not available.")
+	monkeypatch.setattr(timers, "timerfd", unavailable)
+	w = timer_wheel()
+	assert w.fd is None
+	w.schedule("a", 0.05)
+	start = now()
+	assert w.wait() == ["a"]
+	assert now() - start >= 0.04
+
+def test_timers_within_slack_share_a_wakeup(wheel):
+	wheel.schedule("a", 0.05, 0.1)
+	wheel.schedule("b", 0.1)
+	start = now()
+	assert wheel.wait() == ["a", "b"]
+	assert 0.09 <= now() - start < 0.5
+	assert wheel.wakeups == 1
+
+def test_timers_beyond_slack_fire_separately(wheel):
+	wheel.schedule("a", 0.02)
+	wheel.schedule("b", 0.2)
+	assert wheel.wait() == ["a"]
+	assert wheel.pending("b") and not wheel.pending("a")
+	assert wheel.wait() == ["b"]
+	assert wheel.wakeups == 2
+
+def test_timers_fire_in_due_order(wheel):
+	wheel.schedule("c", 0.03)
+	wheel.schedule("a", 0.01)
+	wheel.schedule("b", 0.02)
+	wheel.schedule("later", 10)
+	time.sleep(0.05)
+	assert wheel.wait() == ["a", "b", "c"]
+	assert wheel.pending("later")
+
+def test_overdue_timers_cost_no_wakeup(wheel):
+	wheel.schedule("a", 0)
+	assert wheel.wait() == ["a"]
+	assert wheel.wakeups == 0
+
+def test_schedule_replaces_and_cancel_removes(wheel):
+	wheel.schedule("a", 10)
+	wheel.schedule("a", 0)
+	wheel.schedule("b", 0)
+	wheel.cancel("b")
+	assert wheel.wait() == ["a"]
+	assert not wheel.pending("b")
+
+def test_wakeups_per_hour(wheel):
+	wheel.started = now() - 1800
+	wheel.wakeups = 3
+	assert wheel.wakeups_per_hour() == pytest.approx(6, rel=1e-3)
+	# Very short runs are measured over at least one second.
+	wheel.started = now()
+	assert wheel.wakeups_per_hour() == pytest.approx(3 * 3600, rel=1e-3)
@@ -0,0 +1,179 @@
+"""
+File Name: timers.py
+
+# Introduction
+
+This file contains a timer wheel that lets a daemon schedule all of its
+periodic work (e.g. address checks, pending-change polls, reconciliation, and
+watchdog pings) on a single timer, so that it wakes up as rarely as possible.
+This matters on low-power machines, where every wakeup costs power.
+
+Each timer has a due time and a slack. The wheel sleeps until the latest
+instant at which no timer would be later than its due time plus its slack, and
+then fires every timer that is due by then. Timers that are due at nearby times
+are therefore handled by a single wakeup.
+
+Time is measured with `CLOCK_BOOTTIME`, which keeps running while the machine
+is suspended. Timers that fell due during a suspension fire right after resume,
+rather than being postponed by the length of the suspension as they would be
+with `CLOCK_MONOTONIC`. On Linux, the wheel sleeps on a `timerfd` armed with an
+absolute expiry time on the same clock, so a suspension cannot make the wheel
+oversleep either.
+"""
+
+import os
+import time
+import ctypes
+import struct
+import logging
+
+CLOCK_BOOTTIME    = getattr(time, "CLOCK_BOOTTIME", None)
+TFD_CLOEXEC       = 0o2000000
+TFD_TIMER_ABSTIME = 1
+
+"""
+Returns the current time in floating-point seconds on the clock used by the
+wheel.
+"""
+def now():
+	if CLOCK_BOOTTIME is not None:
+		return time.clock_gettime(CLOCK_BOOTTIME)
+	return time.monotonic()
+
+class timespec(ctypes.Structure):
+	_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+class itimerspec(ctypes.Structure):
+	_fields_ = [("it_interval", timespec), ("it_value", timespec)]
+
+"""
+A one-shot `timerfd` on `CLOCK_BOOTTIME`. The functions in the `os` module are
+used if they are available (Python 3.13 and later); otherwise, the system calls
+are made through `ctypes`. Raises `OSError` if `timerfd` is not supported.
+"""
+class timerfd:
+	def __init__(self):
+		if CLOCK_BOOTTIME is None:
+			raise OSError("CLOCK_BOOTTIME is not available.")
+		if hasattr(os, "timerfd_create"):
+			self.libc = None
+			self.fd = os.timerfd_create(CLOCK_BOOTTIME, flags=os.TFD_CLOEXEC)
+			return
+
+		self.libc = ctypes.CDLL(None, use_errno=True)
+		if not hasattr(self.libc, "timerfd_create"):
+			raise OSError("timerfd is not available.")
+		self.fd = self.libc.timerfd_create(CLOCK_BOOTTIME, TFD_CLOEXEC)
+		if self.fd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e))
+
+	"""
+	Blocks until the clock reaches `when`. Returns immediately if `when` is
+	in the past.
+	"""
+	def wait_until(self, when):
+		# An expiry time of zero would disarm the timer instead.
+		when = max(when, 1e-9)
+		if self.libc is None:
+			os.timerfd_settime(self.fd, flags=os.TFD_TIMER_ABSTIME,
+				initial=when)
+		else:
+			spec = itimerspec()
+			spec.it_value.tv_sec = int(when)
+			spec.it_value.tv_nsec = int((when - int(when)) * 1e9)
+			if self.libc.timerfd_settime(self.fd, TFD_TIMER_ABSTIME,
+				ctypes.byref(spec), None) != 0:
+				e = ctypes.get_errno()
+				raise OSError(e, os.strerror(e))
+		# Returns the number of expirations once the timer fires.
+		struct.unpack("Q", os.read(self.fd, 8))
+
+	def close(self):
+		os.close(self.fd)
+
+"""
+Summary of parameters:
+
+  - `suspend_threshold` is the number of floating-point seconds by which
+    `CLOCK_BOOTTIME` must get ahead of `CLOCK_MONOTONIC` during a sleep for it
+    to be counted as a suspension.
+"""
+class timer_wheel:
+	def __init__(self, suspend_threshold=1):
+		logger = logging.getLogger("aws_dns")
+		self.timers            = {}
+		self.suspend_threshold = suspend_threshold
+		self.wakeups           = 0
+		self.started           = now()
+		self.suspended         = 0
+		try:
+			self.fd = timerfd()
+		except OSError as e:
+			logger.info("Falling back to sleep for timers: {0}".format(e))
+			self.fd = None
+
+	"""
+	Schedules the timer `name` to fire after `delay` floating-point seconds,
+	allowing it to fire up to `slack` seconds late so that it can share a
+	wakeup with other timers. Replaces any existing timer with that name.
+	"""
+	def schedule(self, name, delay, slack=0):
+		self.timers[name] = (now() + delay, slack)
+
+	def now(self):
+		return now()
+
+	def cancel(self, name):
+		self.timers.pop(name, None)
+
+	def pending(self, name):
+		return name in self.timers
+
+	"""
+	Returns the time at which the wheel will next wake up.
+	"""
+	def next_wakeup(self):
+		return min(due + slack for (due, slack) in self.timers.values())
+
+	def sleep_until(self, when):
+		if self.fd is not None:
+			self.fd.wait_until(when)
+		else:
+			time.sleep(max(0, when - now()))
+
+	"""
+	Sleeps until the next wakeup, and returns the names of the timers that
+	have fired, in the order in which they were due. Fired timers are
+	removed, so they have to be scheduled again if they are periodic.
+	"""
+	def wait(self):
+		logger = logging.getLogger("aws_dns")
+		(boot, mono) = (now(), time.monotonic())
+		when = self.next_wakeup()
+		# Timers that are already overdue do not cost a wakeup.
+		if when > boot:
+			self.sleep_until(when)
+			self.wakeups += 1
+
+		# `CLOCK_MONOTONIC` stops while the machine is suspended.
+		t = now()
+		suspended = (t - boot) - (time.monotonic() - mono)
+		if suspended >= self.suspend_threshold:
+			self.suspended += suspended
+			logger.info("Resumed after {0:.0f} seconds of suspension.".
+				format(suspended))
+
+		fired = sorted((due, name) for (name, (due, _)) in
+			self.timers.items() if due <= t)
+		for (_, name) in fired:
+			del self.timers[name]
+		return [name for (_, name) in fired]
+
+	def wakeups_per_hour(self):
+		hours = max(now() - self.started, 1) / 3600
+		return self.wakeups / hours
+
+	def close(self):
+		if self.fd is not None:
+			self.fd.close()